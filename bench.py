@@ -0,0 +1,379 @@
+# bench.py
+# Офлайн-бенчмарк обработчиков бота: без Telegram API, на временной SQLite-базе
+# или на хранилище в памяти (--backend memory).
+#
+#   python bench.py --output bench_results.json
+#   python bench.py --scenario storm --users 200
+#   python bench.py --backend memory
+#
+# Для каждого сценария печатаются p50/p99 задержки, пропускная способность и
+# число SQL-запросов / новых соединений на одно взаимодействие; результаты
+# сохраняются в JSON, чтобы сравнивать прогоны между версиями.
+#
+# Задержка обработчика не включает отправку правок: они уходят из очереди outbox.
+# С --telegram-limits очередь работает с настоящими лимитами Telegram, и для
+# каждого сценария печатается ожидание ответов на нажатия в очереди (p50/p99/max).
+import os
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+# main.py и db.py читают настройки при импорте
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("SUPER_ADMIN_ID", "1")
+os.environ.setdefault("ALLOWED_CHAT_ID", "-1001")
+os.environ.setdefault("ALLOWED_THREAD_ID", "7")
+
+import db  # noqa: E402
+import main  # noqa: E402
+from metrics import metrics  # noqa: E402
+from outbox import Outbox  # noqa: E402
+from throttle import CallbackThrottle  # noqa: E402
+from storage import BACKENDS, create_storage  # noqa: E402
+
+# Все сценарии идут в календаре по умолчанию
+BENCH_CHAT_ID, BENCH_THREAD_ID = main.DEFAULT_TENANT
+
+
+# --- Счётчики SQLite: новые соединения и выполненные запросы ---
+class DbCounters:
+    def __init__(self):
+        self.connections = 0
+        self.queries = 0
+        self._connect = None
+
+    def _trace(self, statement):
+        self.queries += 1
+
+    def install(self):
+        self._connect = sqlite3.connect
+
+        def connect(*args, **kwargs):
+            conn = self._connect(*args, **kwargs)
+            self.connections += 1
+            conn.set_trace_callback(self._trace)
+            return conn
+
+        sqlite3.connect = connect
+
+    def uninstall(self):
+        if self._connect is not None:
+            sqlite3.connect = self._connect
+            self._connect = None
+
+    def snapshot(self):
+        return self.connections, self.queries
+
+
+# --- Заглушки Telegram: только то, что используют обработчики ---
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+        self._message_ids = 1000
+
+    def next_message_id(self):
+        self._message_ids += 1
+        return self._message_ids
+
+    async def send_message(self, chat_id, text, message_thread_id=None, **kwargs):
+        self.calls.append(("send_message", chat_id, text))
+        return FakeMessage(self, chat_id, message_thread_id, self.next_message_id())
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(("edit_message_text", chat_id, message_id, text))
+        return True
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.calls.append(("answer_callback_query", callback_query_id, text))
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.calls.append(("delete_message", chat_id, message_id))
+        return True
+
+
+class FakeUser:
+    def __init__(self, user_id: int, username: str = None):
+        self.id = user_id
+        self.username = username
+        self.full_name = username or f"User {user_id}"
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, message_thread_id: int, message_id: int):
+        self._bot = bot
+        self.chat_id = chat_id
+        self.message_thread_id = message_thread_id
+        self.message_id = message_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, message_thread_id=self.message_thread_id, **kwargs)
+
+    async def delete(self):
+        return await self._bot.delete_message(self.chat_id, self.message_id)
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot: FakeBot, query_id: str, data: str, from_user: FakeUser, message: FakeMessage):
+        self._bot = bot
+        self.id = query_id
+        self.data = data
+        self.from_user = from_user
+        self.message = message
+
+    async def answer(self, text=None, **kwargs):
+        return await self._bot.answer_callback_query(self.id, text, **kwargs)
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self._bot.edit_message_text(
+            text, chat_id=self.message.chat_id, message_id=self.message.message_id, **kwargs
+        )
+
+
+class FakeUpdate:
+    def __init__(self, message: FakeMessage = None, callback_query: FakeCallbackQuery = None, user: FakeUser = None):
+        self.message = message
+        self.callback_query = callback_query
+        self.effective_user = user or (callback_query.from_user if callback_query else None)
+
+    @property
+    def effective_message(self):
+        return self.message or (self.callback_query.message if self.callback_query else None)
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot, args=None):
+        self.bot = bot
+        self.args = args or []
+
+
+class Harness:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self._query_ids = 0
+
+    def message(self, message_id: int = None):
+        return FakeMessage(self.bot, BENCH_CHAT_ID, BENCH_THREAD_ID, message_id or self.bot.next_message_id())
+
+    def command(self, user: FakeUser, args=None):
+        update = FakeUpdate(message=self.message(), user=user)
+        return update, FakeContext(self.bot, args)
+
+    def callback(self, user: FakeUser, data: str, message: FakeMessage = None):
+        self._query_ids += 1
+        query = FakeCallbackQuery(self.bot, str(self._query_ids), data, user, message or self.message())
+        return FakeUpdate(callback_query=query), FakeContext(self.bot)
+
+
+# --- Измерения ---
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+
+    async def run(self, handler, update, context):
+        started = time.perf_counter()
+        await handler(update, context)
+        self.latencies.append(time.perf_counter() - started)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# Состояние main.py между сценариями: отрисованные календари, отслеживаемые
+# сообщения и ограничитель нажатий не должны переходить из прошлого сценария
+def reset_bot_state():
+    main._calendar_cache.clear()
+    main._prefetching.clear()
+    main._open_calendars.clear()
+    main._refresh_scheduled.clear()
+    main.callback_throttle = CallbackThrottle()
+
+
+async def run_scenario(name, scenario, args):
+    reset_bot_state()
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.TENANT_DB_DIR = os.path.join(tmp, "tenants")
+        counters = DbCounters()
+        counters.install()
+        main.storage = create_storage(args.backend)
+        try:
+            await main.storage.init(main.DEFAULT_TENANT)
+            bot = FakeBot()
+            if args.telegram_limits:
+                main.outbox = Outbox(edit_rate=main.OUTBOX_EDIT_RATE, edit_burst=main.OUTBOX_EDIT_BURST,
+                                     on_error=main.on_edit_failed)
+            else:
+                # Без --telegram-limits правки уходят в FakeBot сразу
+                main.outbox = Outbox(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, on_error=main.on_edit_failed)
+            main.outbox.start(bot)
+            metrics.clear("bot_outbox_wait_seconds")
+            harness = Harness(bot)
+            recorder = Recorder()
+            connections_before, queries_before = counters.snapshot()
+            started = time.perf_counter()
+            extra = await scenario(harness, recorder, args)
+            elapsed = time.perf_counter() - started
+            connections_after, queries_after = counters.snapshot()
+        finally:
+            await main.post_stop(None)
+            await main.storage.close()
+            counters.uninstall()
+
+    interactions = len(recorder.latencies)
+    result = {
+        "scenario": name,
+        "backend": args.backend,
+        "interactions": interactions,
+        "elapsed_s": elapsed,
+        "throughput_per_s": interactions / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(recorder.latencies, 50) * 1000,
+        "p99_ms": percentile(recorder.latencies, 99) * 1000,
+        "max_ms": max(recorder.latencies, default=0.0) * 1000,
+        "db_queries_per_interaction": (queries_after - queries_before) / interactions if interactions else 0.0,
+        "db_connections_per_interaction": (connections_after - connections_before) / interactions if interactions else 0.0,
+        "telegram_calls": len(bot.calls),
+    }
+    # Ожидание в очереди правок: post_stop уже дождался отправки накопленных правок
+    for lane, h in metrics.histograms("bot_outbox_wait_seconds").items():
+        prefix = f"edit_wait_{dict(lane)['lane']}"
+        result.update({
+            f"{prefix}_p50_ms": h.percentile(50) * 1000,
+            f"{prefix}_p99_ms": h.percentile(99) * 1000,
+            f"{prefix}_max_ms": h.max * 1000,
+        })
+    result.update(extra or {})
+    return result
+
+
+# --- Сценарии ---
+async def scenario_calendar(harness: Harness, recorder: Recorder, args):
+    # /book, листание месяцев и "Назад к календарю" от разных пользователей
+    users = [FakeUser(100 + i, f"user{100 + i}") for i in range(args.users)]
+    for i in range(args.iterations):
+        user = users[i % len(users)]
+        if i % 3 == 0:
+            update, context = harness.command(user)
+            await recorder.run(main.start, update, context)
+        else:
+            page = (i // 3) % 3 if i % 3 == 1 else 0
+            update, context = harness.callback(user, f"cal_{page}")
+            await recorder.run(main.back_to_calendar, update, context)
+
+
+async def scenario_storm(harness: Harness, recorder: Recorder, args):
+    # Все пользователи одновременно открывают и подтверждают одну и ту же дату
+    target = (date.today() + timedelta(days=3)).isoformat()
+    users = [FakeUser(1000 + i, f"storm{i}") for i in range(args.users)]
+
+    async def tap(user):
+        update, context = harness.callback(user, f"book_{target}")
+        await recorder.run(main.handle_date_callback, update, context)
+        update, context = harness.callback(user, f"confirm_{target}")
+        await recorder.run(main.confirm_booking, update, context)
+
+    rounds = max(1, args.iterations // (2 * len(users)))
+    for _ in range(rounds):
+        await asyncio.gather(*(tap(user) for user in users))
+    booking = await main.storage.get_booking(target)
+    return {"storm_winner": booking["user_id"] if booking else None}
+
+
+async def scenario_mixed(harness: Harness, recorder: Recorder, args):
+    # Обычные пользователи и спонсоры: просмотр, бронь, отмена, возврат к календарю
+    rng = random.Random(args.seed)
+    users = [FakeUser(2000 + i, f"mixed{i}") for i in range(args.users)]
+    sponsors = users[: max(1, len(users) // 5)]
+    for user in sponsors:
+        await main.storage.ensure_user(user.id, user.username)
+        await main.storage.set_sponsor_status(user.id, True)
+    dates = [(date.today() + timedelta(days=i)).isoformat() for i in range(30)]
+
+    async def session(user):
+        message = harness.message()
+        update, context = harness.command(user)
+        await recorder.run(main.start, update, context)
+        date_str = rng.choice(dates)
+        update, context = harness.callback(user, f"book_{date_str}", message)
+        await recorder.run(main.handle_date_callback, update, context)
+        update, context = harness.callback(user, f"confirm_{date_str}", message)
+        await recorder.run(main.confirm_booking, update, context)
+        if rng.random() < 0.3:
+            update, context = harness.callback(user, f"cancel_{date_str}", message)
+            await recorder.run(main.cancel_booking_handler, update, context)
+        update, context = harness.callback(user, "back_calendar", message)
+        await recorder.run(main.back_to_calendar, update, context)
+
+    sessions = max(1, args.iterations // 5)
+    for start in range(0, sessions, len(users)):
+        batch = users[: min(len(users), sessions - start)]
+        await asyncio.gather(*(session(user) for user in batch))
+    bookings = await main.storage.get_bookings_between(dates[0], dates[-1])
+    return {"booked_dates": len(bookings)}
+
+
+SCENARIOS = {
+    "calendar": scenario_calendar,
+    "storm": scenario_storm,
+    "mixed": scenario_mixed,
+}
+
+
+async def run(args):
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    return [await run_scenario(name, SCENARIOS[name], args) for name in names]
+
+
+def print_result(result):
+    print(
+        f"{result['scenario']:>9}: {result['interactions']} взаимодействий, "
+        f"p50 {result['p50_ms']:.2f} мс, p99 {result['p99_ms']:.2f} мс, "
+        f"{result['throughput_per_s']:.0f}/с, "
+        f"запросов {result['db_queries_per_interaction']:.1f}, "
+        f"соединений {result['db_connections_per_interaction']:.2f} на взаимодействие"
+    )
+    if "edit_wait_interactive_p99_ms" in result:
+        print(
+            f"{'':>9}  очередь правок: p50 {result['edit_wait_interactive_p50_ms']:.2f} мс, "
+            f"p99 {result['edit_wait_interactive_p99_ms']:.2f} мс, max {result['edit_wait_interactive_max_ms']:.2f} мс"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument("--scenario", choices=["all", *SCENARIOS], default="all")
+    parser.add_argument("--iterations", type=int, default=1000, help="взаимодействий на сценарий (примерно)")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--backend", choices=list(BACKENDS), default="sqlite", help="хранилище (см. storage.py)")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="очередь правок с настоящими лимитами Telegram (OUTBOX_EDIT_RATE из окружения)")
+    parser.add_argument("--output", help="куда сохранить результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def bench_main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    for result in results:
+        print_result(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {"timestamp": time.time(), "args": vars(args), "results": results},
+                f, ensure_ascii=False, indent=2
+            )
+
+
+if __name__ == "__main__":
+    bench_main()
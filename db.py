@@ -2,44 +2,523 @@
 import sqlite3
 import os
 import asyncio
+import time
+import queue
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
+from metrics import observe_db
+
 load_dotenv()
 DB_PATH = "reservations.db"
+# Брони остальных календарей (чатов/топиков) лежат в отдельных файлах в этой папке
+TENANT_DB_DIR = os.getenv("TENANT_DB_DIR", "tenants")
 SUPER_ADMIN_ID = int(os.getenv("SUPER_ADMIN_ID"))
+DB_BUSY_TIMEOUT_MS = 5000
+# Окно кэша броней покрывает текущий и следующий месяц календаря (≤ 62 дней от сегодня)
+BOOKING_CACHE_DAYS = 62
+USER_CACHE_SIZE = 10000
+# Архивация прошедших броней: строк на транзакцию
+ARCHIVE_BATCH_SIZE = 500
+# Журнал аудита пишется пачками: не больше AUDIT_BATCH_SIZE событий за транзакцию,
+# событие ждёт попутчиков не дольше AUDIT_FLUSH_INTERVAL секунд
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 0.2
 
-def _init_db_sync():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+logger = logging.getLogger(__name__)
+
+
+# --- Движок хранения: одно долгоживущее соединение в выделенном потоке ---
+# Все запросы идут через один поток, поэтому соединение создаётся один раз,
+# PRAGMA настраиваются при подключении, а обращения к SQLite не конкурируют между собой.
+class _DbWorker:
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    def _connect(self):
+        # isolation_level=None — транзакции открываем явно через _transaction()
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        # Действует только для нового файла; существующие переводит _maintain_sync
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def _call(self, fn, args, submitted: float):
+        started = time.perf_counter()
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            return fn(self._conn, *args)
+        finally:
+            operation = fn.__name__.strip("_").removesuffix("_sync")
+            observe_db(operation, started - submitted, time.perf_counter() - started)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args, time.perf_counter())
+
+    def submit(self, fn, *args):
+        return self._executor.submit(self._call, fn, args, time.perf_counter())
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=True)
+
+
+# --- Кэш броней видимого окна (сегодня + BOOKING_CACHE_DAYS) ---
+# Заполняется целиком одним запросом и обновляется на каждой записи в потоке БД,
+# чтение идёт из потока событий без обращения к SQLite.
+#
+# Версии броней берутся из одного счётчика на процесс: по ним main кэширует
+# отрисованные календари, и календарь новой базы (после close_db/init_db или
+# другого хранилища) не должен совпасть по версии с календарём прежней.
+_bookings_versions = itertools.count(1)
+
+def next_bookings_version() -> int:
+    return next(_bookings_versions)
+
+class _BookingCache:
+    def __init__(self, days: int):
+        self.days = days
+        self.start = None  # границы окна, ISO-строки включительно
+        self.end = None
+        self.hits = 0
+        self.misses = 0
+        self.version = next_bookings_version()  # меняется на каждой записи в bookings
+        self._bookings = {}  # только занятые даты; дата окна без записи — свободна
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def window(days: int):
+        today = date.today()
+        return today.isoformat(), (today + timedelta(days=days - 1)).isoformat()
+
+    def _evict_past(self):
+        today = date.today().isoformat()
+        if self.start is None or self.start >= today:
+            return
+        if self.end < today:
+            self.start = self.end = None
+            self._bookings = {}
+            return
+        self._bookings = {d: b for d, b in self._bookings.items() if d >= today}
+        self.start = today
+
+    def _covers(self, start_str: str, end_str: str) -> bool:
+        self._evict_past()
+        return self.start is not None and self.start <= start_str and end_str <= self.end
+
+    def load(self, start_str: str, end_str: str, bookings: dict):
+        with self._lock:
+            self.start, self.end = start_str, end_str
+            self._bookings = dict(bookings)
+
+    def get(self, date_str: str):
+        with self._lock:
+            if self._covers(date_str, date_str):
+                self.hits += 1
+                return True, self._bookings.get(date_str)
+            self.misses += 1
+            return False, None
+
+    def get_range(self, start_str: str, end_str: str):
+        with self._lock:
+            if self._covers(start_str, end_str):
+                self.hits += 1
+                return True, {d: b for d, b in self._bookings.items() if start_str <= d <= end_str}
+            self.misses += 1
+            return False, None
+
+    def put(self, date_str: str, booking):
+        with self._lock:
+            self.version = next_bookings_version()
+            if self.start is None or not (self.start <= date_str <= self.end):
+                return
+            if booking is None:
+                self._bookings.pop(date_str, None)
+            else:
+                self._bookings[date_str] = booking
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._bookings),
+                "start": self.start,
+                "end": self.end,
+            }
+
+
+# --- Шарды: у каждого календаря (chat_id, thread_id) свой файл, поток БД и кэш броней ---
+# Пользователи общие и хранятся в основной базе DB_PATH; там же брони календаря
+# по умолчанию (tenant=None), чтобы существующий reservations.db продолжал работать.
+class _Shard:
+    def __init__(self, path: str, is_main: bool, tenant):
+        self.path = path
+        self.is_main = is_main
+        self.tenant = tenant
+        self.worker = _DbWorker(path)
+        self.cache = _BookingCache(BOOKING_CACHE_DAYS)
+        self.ready = None  # future инициализации схемы и кэша
+
+    async def run(self, fn, *args):
+        return await self.worker.run(fn, *args)
+
+
+_shards = {}  # путь к файлу -> _Shard
+_default_tenant = None
+
+def _shard_path(tenant) -> str:
+    if tenant is None or tenant == _default_tenant:
+        return DB_PATH
+    chat_id, thread_id = tenant
+    return os.path.join(TENANT_DB_DIR, f"{chat_id}_{thread_id or 0}.db")
+
+def _main() -> _Shard:
+    return _shard(None)
+
+def _shard(tenant) -> _Shard:
+    path = _shard_path(tenant)
+    shard = _shards.get(path)
+    if shard is None:
+        is_main = path == DB_PATH
+        if not is_main:
+            os.makedirs(TENANT_DB_DIR, exist_ok=True)
+        shard = _shards[path] = _Shard(path, is_main, _default_tenant if is_main else tenant)
+        # Поток шарда выполняет задачи по порядку: схема и окно кэша
+        # будут готовы раньше любого запроса к новому шарду
+        shard.ready = shard.worker.submit(_init_shard_sync, shard.is_main, shard.cache)
+    return shard
+
+
+# --- Журнал аудита: фоновая запись пачками (write-behind) ---
+# Операции с бронями только кладут событие в очередь; отдельный поток со своим
+# соединением к основной базе пишет накопившиеся события одной транзакцией.
+# close_db останавливает поток только после записи всех событий из очереди.
+AUDIT_BOOK = "book"
+AUDIT_REPLACE = "replace"
+AUDIT_CANCEL = "cancel"
+
+_AUDIT_STOP = object()
+
+class _AuditWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-audit", daemon=True)
+        self._thread.start()
+
+    def record(self, tenant, action: str, date_str: str, user_id: int, username: str, previous=None):
+        chat_id, thread_id = tenant if tenant is not None else (None, None)
+        self._queue.put((
+            time.time(), chat_id, thread_id, action, date_str, user_id, username,
+            previous["user_id"] if previous else None,
+            previous["username"] if previous else None,
+        ))
+
+    # Событие-метка: выставляется, когда всё поставленное раньше записано
+    def flush_marker(self) -> threading.Event:
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker
+
+    @staticmethod
+    def _ends_batch(item) -> bool:
+        return item is _AUDIT_STOP or isinstance(item, threading.Event)
+
+    def _collect(self, first):
+        batch = [first]
+        if self._ends_batch(first):
+            return batch
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while len(batch) < AUDIT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if self._ends_batch(item):
+                break
+        return batch
+
+    def _write(self, conn, events):
+        if not events:
+            return
+        with _transaction(conn) as c:
+            c.executemany('''
+                INSERT INTO audit_log (
+                    ts, chat_id, thread_id, action, date, user_id, username,
+                    previous_user_id, previous_username
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', events)
+        self.written += len(events)
+
+    def _run(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            stopping = False
+            while not stopping:
+                batch = self._collect(self._queue.get())
+                events = []
+                markers = []
+                for item in batch:
+                    if item is _AUDIT_STOP:
+                        stopping = True
+                    elif isinstance(item, threading.Event):
+                        markers.append(item)
+                    else:
+                        events.append(item)
+                try:
+                    self._write(conn, events)
+                except sqlite3.Error:
+                    logger.exception("audit batch of %d events lost", len(events))
+                for marker in markers:
+                    marker.set()
+        finally:
+            conn.close()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(_AUDIT_STOP)
+        self._thread.join()
+
+
+_audit = None
+# Запись броней идёт из потоков разных календарей: писатель создаётся строго один,
+# иначе close_db дождался бы только одного из них
+_audit_lock = threading.Lock()
+
+def _audit_writer() -> _AuditWriter:
+    global _audit
+    with _audit_lock:
+        if _audit is None:
+            _audit = _AuditWriter(DB_PATH)
+        return _audit
+
+
+# --- Кэш профилей пользователей (user_id -> профиль), LRU на USER_CACHE_SIZE записей ---
+class _UserCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int):
+        with self._lock:
+            profile = self._users.get(user_id)
+            if profile is None:
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return profile
+
+    def put(self, profile):
+        with self._lock:
+            self._users[profile["user_id"]] = profile
+            self._users.move_to_end(profile["user_id"])
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._users)}
+
+
+_user_cache = _UserCache(USER_CACHE_SIZE)
+
+@contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+# --- Миграции схемы ---
+# Версия схемы файла хранится в PRAGMA user_version: миграция N переводит базу
+# с версии N-1 на N. Новые изменения схемы — только добавлением функции в конец MIGRATIONS.
+# Основная база (is_main) содержит пользователей, базы календарей — только брони.
+# Журнал WAL включается при подключении (_DbWorker._connect) и сохраняется в файле.
+def _migration_base_tables(c, is_main: bool):
+    if is_main:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                is_sponsor BOOLEAN DEFAULT 0,
+                is_super_admin BOOLEAN DEFAULT 0
+            )
+        ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            date TEXT PRIMARY KEY,
+            user_id INTEGER,
+            username TEXT,
+            is_sponsor BOOLEAN
+        )
+    ''')
+
+def _migration_lookup_indexes(c, is_main: bool):
+    # get_user_id_by_username сравнивает с COLLATE NOCASE — индекс в той же коллации
+    if is_main:
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings (user_id)")
+
+def _migration_audit_log(c, is_main: bool):
+    # Журнал всех изменений броней всех календарей — в основной базе
+    if not is_main:
+        return
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            chat_id INTEGER,
+            thread_id INTEGER,
+            action TEXT NOT NULL,
+            date TEXT NOT NULL,
+            user_id INTEGER,
+            username TEXT,
+            previous_user_id INTEGER,
+            previous_username TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_tenant ON audit_log (chat_id, thread_id, id)")
+
+def _migration_booking_counters(c, is_main: bool):
+    # Счётчики для отчётов: дни броней по пользователям и по месяцам.
+    # Ведутся в тех же транзакциях, что и изменения bookings (см. _count_bookings)
     c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
+        CREATE TABLE IF NOT EXISTS user_booking_stats (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
-            is_sponsor BOOLEAN DEFAULT 0,
-            is_super_admin BOOLEAN DEFAULT 0
+            days INTEGER NOT NULL DEFAULT 0,
+            sponsor_days INTEGER NOT NULL DEFAULT 0
         )
     ''')
     c.execute('''
-        INSERT OR IGNORE INTO users (user_id, is_super_admin)
-        VALUES (?, 1)
-    ''', (SUPER_ADMIN_ID,))
+        CREATE TABLE IF NOT EXISTS month_booking_stats (
+            month TEXT PRIMARY KEY,
+            days INTEGER NOT NULL DEFAULT 0,
+            sponsor_days INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_booking_stats_days ON user_booking_stats (days)")
+    c.execute("DROP INDEX IF EXISTS idx_bookings_user_id")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bookings_user_date ON bookings (user_id, date)")
+    # Начальные значения — по уже существующим броням
     c.execute('''
-        CREATE TABLE IF NOT EXISTS bookings (
+        INSERT INTO user_booking_stats (user_id, username, days, sponsor_days)
+        SELECT user_id, MAX(username), COUNT(*), SUM(is_sponsor)
+        FROM bookings GROUP BY user_id
+    ''')
+    c.execute('''
+        INSERT INTO month_booking_stats (month, days, sponsor_days)
+        SELECT substr(date, 1, 7), COUNT(*), SUM(is_sponsor)
+        FROM bookings GROUP BY substr(date, 1, 7)
+    ''')
+
+def _migration_bookings_archive(c, is_main: bool):
+    # Прошедшие брони переносятся сюда (archive_bookings), bookings остаётся размером с горизонт календаря.
+    # Счётчики отчётов при переносе не меняются: это история, а не отмена
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bookings_archive (
             date TEXT PRIMARY KEY,
             user_id INTEGER,
             username TEXT,
-            is_sponsor BOOLEAN
+            is_sponsor BOOLEAN,
+            archived_at REAL NOT NULL
         )
     ''')
-    conn.commit()
-    conn.close()
 
-def _get_user_sync(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+def _migration_booking_totals(c, is_main: bool):
+    # Итоги отчёта одной строкой, чтобы /occupancy не суммировал счётчики всех пользователей.
+    # Начальные значения — из счётчиков пользователей (в них учтены и архивные брони)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS booking_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            days INTEGER NOT NULL DEFAULT 0,
+            sponsor_days INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO booking_totals (id, days, sponsor_days)
+        SELECT 1, COALESCE(SUM(days), 0), COALESCE(SUM(sponsor_days), 0) FROM user_booking_stats
+    ''')
+
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_lookup_indexes,
+    _migration_audit_log,
+    _migration_booking_counters,
+    _migration_bookings_archive,
+    _migration_booking_totals,
+]
+
+def _schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _migrate_sync(conn, is_main: bool):
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if _schema_version(conn) >= version:
+            continue
+        with _transaction(conn) as c:
+            # Перепроверяем под блокировкой записи: другой процесс мог успеть обновить файл
+            if _schema_version(conn) >= version:
+                continue
+            migration(c, is_main)
+            c.execute(f"PRAGMA user_version = {version}")
+
+def _init_db_sync(conn, is_main: bool):
+    _migrate_sync(conn, is_main)
+    if is_main:
+        with _transaction(conn) as c:
+            c.execute('''
+                INSERT OR IGNORE INTO users (user_id, is_super_admin)
+                VALUES (?, 1)
+            ''', (SUPER_ADMIN_ID,))
+
+def _get_user_sync(conn, user_id: int):
     c = conn.cursor()
     c.execute("SELECT user_id, username, is_sponsor, is_super_admin FROM users WHERE user_id = ?", (user_id,))
     row = c.fetchone()
-    conn.close()
     if row:
         return {
             "user_id": row[0],
@@ -49,28 +528,27 @@ def _get_user_sync(user_id: int):
         }
     return None
 
-def _ensure_user_sync(user_id: int, username: str = None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username or "unknown"))
-    if username:
-        c.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
-    conn.commit()
-    conn.close()
-
-def _set_sponsor_status_sync(target_user_id: int, is_sponsor: bool):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET is_sponsor = ? WHERE user_id = ?", (int(is_sponsor), target_user_id))
-    conn.commit()
-    conn.close()
+def _ensure_user_sync(conn, user_id: int, username: str = None):
+    # Пишем только если пользователя нет или его username изменился
+    profile = _get_user_sync(conn, user_id)
+    if profile is None or (username and profile["username"] != username):
+        with _transaction(conn) as c:
+            c.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username or "unknown"))
+            if username:
+                c.execute("UPDATE users SET username = ? WHERE user_id = ? AND username IS NOT ?", (username, user_id, username))
+        profile = _get_user_sync(conn, user_id)
+    _user_cache.put(profile)
+    return profile
 
-def _get_booking_sync(date_str: str):
-    conn = sqlite3.connect(DB_PATH)
+def _set_sponsor_status_sync(conn, target_user_id: int, is_sponsor: bool):
+    with _transaction(conn) as c:
+        c.execute("UPDATE users SET is_sponsor = ? WHERE user_id = ?", (int(is_sponsor), target_user_id))
+    _user_cache.invalidate(target_user_id)
+
+def _get_booking_sync(conn, date_str: str):
     c = conn.cursor()
     c.execute("SELECT user_id, username, is_sponsor FROM bookings WHERE date = ?", (date_str,))
     row = c.fetchone()
-    conn.close()
     if row:
         return {
             "user_id": row[0],
@@ -79,65 +557,410 @@ def _get_booking_sync(date_str: str):
         }
     return None
 
-def _set_booking_sync(date_str: str, user_id: int, username: str, is_sponsor: bool):
-    conn = sqlite3.connect(DB_PATH)
+# Результаты set_booking
+BOOKING_BOOKED = "booked"                      # дата была свободна
+BOOKING_REPLACED = "replaced"                  # спонсор перебронировал чужую дату
+BOOKING_ALREADY_YOURS = "already_yours"        # дата уже за этим пользователем
+BOOKING_REJECTED_SPONSOR = "rejected_sponsor"  # обычный пользователь против брони спонсора
+BOOKING_TAKEN = "taken"                        # обычный пользователь против брони обычного
+
+# Правила приоритета: общие для всех хранилищ (см. storage.py)
+def booking_decision(current, user_id: int, is_sponsor: bool):
+    if current is None:
+        return BOOKING_BOOKED
+    if current["user_id"] == user_id:
+        return BOOKING_ALREADY_YOURS
+    if is_sponsor:
+        return BOOKING_REPLACED
+    if current["is_sponsor"]:
+        return BOOKING_REJECTED_SPONSOR
+    return BOOKING_TAKEN
+
+_UPSERT_BOOKING_SQL = '''
+    INSERT INTO bookings (date, user_id, username, is_sponsor)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(date) DO UPDATE SET
+        user_id = excluded.user_id,
+        username = excluded.username,
+        is_sponsor = excluded.is_sponsor
+'''
+
+_COUNT_USER_SQL = '''
+    INSERT INTO user_booking_stats (user_id, username, days, sponsor_days)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, username),
+        days = days + excluded.days,
+        sponsor_days = sponsor_days + excluded.sponsor_days
+'''
+
+_COUNT_MONTH_SQL = '''
+    INSERT INTO month_booking_stats (month, days, sponsor_days)
+    VALUES (?, ?, ?)
+    ON CONFLICT(month) DO UPDATE SET
+        days = days + excluded.days,
+        sponsor_days = sponsor_days + excluded.sponsor_days
+'''
+
+# Поправка счётчиков отчётов внутри транзакции изменения bookings.
+# added/removed — брони (date, user_id, username, is_sponsor), появившиеся и снятые
+def _count_bookings(c, added=(), removed=()):
+    users = []
+    months = []
+    for delta, rows in ((1, added), (-1, removed)):
+        for date_str, user_id, username, is_sponsor in rows:
+            sponsor_delta = delta if is_sponsor else 0
+            # Имя обновляем только по новой брони: при снятии оно может быть устаревшим
+            users.append((user_id, username if delta > 0 else None, delta, sponsor_delta))
+            months.append((date_str[:7], delta, sponsor_delta))
+    if not users:
+        return
+    c.executemany(_COUNT_USER_SQL, users)
+    c.executemany(_COUNT_MONTH_SQL, months)
+    c.execute(
+        "UPDATE booking_totals SET days = days + ?, sponsor_days = sponsor_days + ? WHERE id = 1",
+        (sum(row[2] for row in users), sum(row[3] for row in users))
+    )
+
+def _booking_row(date_str: str, booking):
+    return date_str, booking["user_id"], booking["username"], booking["is_sponsor"]
+
+def _set_booking_sync(conn, shard, date_str: str, user_id: int, username: str, is_sponsor: bool):
+    # Проверка приоритета и запись — в одной транзакции BEGIN IMMEDIATE,
+    # поэтому два одновременных нажатия не перезапишут друг друга
+    with _transaction(conn) as c:
+        current = _get_booking_sync(conn, date_str)
+        status = booking_decision(current, user_id, is_sponsor)
+        if status in (BOOKING_BOOKED, BOOKING_REPLACED):
+            row = (date_str, user_id, username, int(is_sponsor))
+            c.execute(_UPSERT_BOOKING_SQL, row)
+            _count_bookings(c, [row], [_booking_row(date_str, current)] if current else [])
+    if status in (BOOKING_BOOKED, BOOKING_REPLACED):
+        _booked(shard, status, date_str, user_id, username, is_sponsor, current)
+    return {"status": status, "previous": current}
+
+# Пакетная бронь: те же правила приоритета для каждой даты, одна транзакция и один executemany
+def _set_bookings_sync(conn, shard, dates, user_id: int, username: str, is_sponsor: bool):
+    results = {}
+    with _transaction(conn) as c:
+        current = _get_bookings_between_sync(conn, min(dates), max(dates))
+        rows = []
+        for date_str in dates:
+            previous = current.get(date_str)
+            status = booking_decision(previous, user_id, is_sponsor)
+            results[date_str] = {"status": status, "previous": previous}
+            if status in (BOOKING_BOOKED, BOOKING_REPLACED):
+                rows.append((date_str, user_id, username, int(is_sponsor)))
+        c.executemany(_UPSERT_BOOKING_SQL, rows)
+        _count_bookings(c, rows, [
+            _booking_row(row[0], current[row[0]]) for row in rows if row[0] in current
+        ])
+    for date_str, _user_id, _username, _is_sponsor in rows:
+        result = results[date_str]
+        _booked(shard, result["status"], date_str, user_id, username, is_sponsor, result["previous"])
+    return results
+
+# После коммита: кэш шарда и событие аудита
+def _booked(shard, status: str, date_str: str, user_id: int, username: str, is_sponsor: bool, previous):
+    shard.cache.put(date_str, {"user_id": user_id, "username": username, "is_sponsor": bool(is_sponsor)})
+    action = AUDIT_REPLACE if status == BOOKING_REPLACED else AUDIT_BOOK
+    _audit_writer().record(shard.tenant, action, date_str, user_id, username, previous)
+
+def _cancelled(shard, date_str: str, user_id: int, username: str):
+    shard.cache.put(date_str, None)
+    _audit_writer().record(shard.tenant, AUDIT_CANCEL, date_str, user_id, username)
+
+def _get_bookings_between_sync(conn, start_str: str, end_str: str):
     c = conn.cursor()
-    current = _get_booking_sync(date_str)
-    if current and current["is_sponsor"] and not is_sponsor:
-        conn.close()
-        return False
-    c.execute('''
-        INSERT OR REPLACE INTO bookings (date, user_id, username, is_sponsor)
-        VALUES (?, ?, ?, ?)
-    ''', (date_str, user_id, username, int(is_sponsor)))
-    conn.commit()
-    conn.close()
-    return True
-
-# Асинхронные обёртки
-async def init_db():
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _init_db_sync)
+    c.execute(
+        "SELECT date, user_id, username, is_sponsor FROM bookings WHERE date BETWEEN ? AND ?",
+        (start_str, end_str)
+    )
+    rows = c.fetchall()
+    return {
+        row[0]: {
+            "user_id": row[1],
+            "username": row[2],
+            "is_sponsor": bool(row[3])
+        }
+        for row in rows
+    }
+
+# Загрузка окна кэша выполняется в потоке БД, поэтому не пересекается с записями
+def _load_booking_cache_sync(conn, cache, start_str: str, end_str: str):
+    bookings = _get_bookings_between_sync(conn, start_str, end_str)
+    cache.load(start_str, end_str, bookings)
+    return bookings
+
+def _init_shard_sync(conn, is_main: bool, cache):
+    _init_db_sync(conn, is_main)
+    _load_booking_cache_sync(conn, cache, *_BookingCache.window(BOOKING_CACHE_DAYS))
+
+# Асинхронные обёртки.
+# tenant — (chat_id, thread_id) календаря; None — календарь по умолчанию.
+async def init_db(default_tenant=None):
+    global _default_tenant
+    _default_tenant = default_tenant
+    await asyncio.wrap_future(_main().ready)
+
+# Версия броней календаря: меняется при каждом set_booking/cancel_booking
+def bookings_version(tenant=None) -> int:
+    return _shard(tenant).cache.version
+
+# Счётчики попаданий/промахов кэшей броней (суммарно по всем календарям)
+def booking_cache_stats():
+    total = {"hits": 0, "misses": 0, "size": 0, "calendars": len(_shards)}
+    for shard in _shards.values():
+        stats = shard.cache.stats()
+        for key in ("hits", "misses", "size"):
+            total[key] += stats[key]
+    return total
+
+# Закрывает соединения и останавливает потоки БД (вызывается при остановке бота).
+# Кэши отражают закрытые базы, поэтому сбрасываются вместе с ними.
+async def close_db():
+    global _default_tenant, _audit
+    shards = list(_shards.values())
+    _shards.clear()
+    _default_tenant = None
+    for shard in shards:
+        await shard.worker.close()
+    # Все операции завершены — дописываем оставшиеся события аудита
+    with _audit_lock:
+        writer, _audit = _audit, None
+    if writer is not None:
+        await asyncio.get_running_loop().run_in_executor(None, writer.close)
+    _user_cache.clear()
+
+# Счётчики кэша профилей пользователей
+def user_cache_stats():
+    return _user_cache.stats()
+
+def _get_user_cached_sync(conn, user_id: int):
+    profile = _get_user_sync(conn, user_id)
+    if profile is not None:
+        _user_cache.put(profile)
+    return profile
 
 async def get_user(user_id: int):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, _get_user_sync, user_id)
+    profile = _user_cache.get(user_id)
+    if profile is not None:
+        return profile
+    return await _main().run(_get_user_cached_sync, user_id)
 
+# Создаёт пользователя / обновляет username и возвращает профиль (как get_user).
+# Если профиль в кэше и username не изменился — обходится без обращения к БД.
 async def ensure_user(user_id: int, username: str = None):
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _ensure_user_sync, user_id, username)
+    profile = _user_cache.get(user_id)
+    if profile is not None and (not username or profile["username"] == username):
+        return profile
+    return await _main().run(_ensure_user_sync, user_id, username)
 
 async def set_sponsor_status(target_user_id: int, is_sponsor: bool):
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _set_sponsor_status_sync, target_user_id, is_sponsor)
+    await _main().run(_set_sponsor_status_sync, target_user_id, is_sponsor)
+
+async def get_booking(date_str: str, tenant=None):
+    shard = _shard(tenant)
+    hit, booking = shard.cache.get(date_str)
+    if hit:
+        return booking
+    return await shard.run(_get_booking_sync, date_str)
+
+# Все брони в диапазоне дат (включительно) одним запросом: {date: booking}
+async def get_bookings_between(start_str: str, end_str: str, tenant=None):
+    shard = _shard(tenant)
+    hit, bookings = shard.cache.get_range(start_str, end_str)
+    if hit:
+        return bookings
+    window_start, window_end = _BookingCache.window(BOOKING_CACHE_DAYS)
+    if window_start <= start_str and end_str <= window_end:
+        # Окно сдвинулось (наступил новый день) — перечитываем его целиком
+        bookings = await shard.run(_load_booking_cache_sync, shard.cache, window_start, window_end)
+        return {d: b for d, b in bookings.items() if start_str <= d <= end_str}
+    return await shard.run(_get_bookings_between_sync, start_str, end_str)
+
+# Возвращает {"status": BOOKING_*, "previous": бронь до изменения или None}
+async def set_booking(date_str: str, user_id: int, username: str, is_sponsor: bool, tenant=None):
+    shard = _shard(tenant)
+    return await shard.run(_set_booking_sync, shard, date_str, user_id, username, is_sponsor)
+
+# Пакетная бронь: {date: {"status": BOOKING_*, "previous": ...}} для каждой даты
+async def set_bookings(dates, user_id: int, username: str, is_sponsor: bool, tenant=None):
+    shard = _shard(tenant)
+    return await shard.run(_set_bookings_sync, shard, list(dates), user_id, username, is_sponsor)
+
+def _cancel_booking_sync(conn, shard, date_str: str):
+    with _transaction(conn) as c:
+        c.execute("DELETE FROM bookings WHERE date = ? RETURNING user_id, username, is_sponsor", (date_str,))
+        deleted = c.fetchone()
+        if deleted:
+            _count_bookings(c, removed=[(date_str, *deleted)])
+    if deleted:
+        _cancelled(shard, date_str, deleted[0], deleted[1])
 
-async def get_booking(date_str: str):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, _get_booking_sync, date_str)
+async def cancel_booking(date_str: str, tenant=None):
+    shard = _shard(tenant)
+    await shard.run(_cancel_booking_sync, shard, date_str)
 
-async def set_booking(date_str: str, user_id: int, username: str, is_sponsor: bool):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, _set_booking_sync, date_str, user_id, username, is_sponsor)
+# Результаты cancel_bookings
+CANCEL_CANCELLED = "cancelled"  # бронь пользователя снята
+CANCEL_NOT_YOURS = "not_yours"  # дата занята другим
+CANCEL_FREE = "free"            # брони не было
 
-def _cancel_booking_sync(date_str: str):
-    conn = sqlite3.connect(DB_PATH)
+# Пакетная отмена: снимаются только брони самого пользователя
+def _cancel_bookings_sync(conn, shard, dates, user_id: int):
+    results = {}
+    with _transaction(conn) as c:
+        current = _get_bookings_between_sync(conn, min(dates), max(dates))
+        owned = []
+        for date_str in dates:
+            booking = current.get(date_str)
+            if booking is None:
+                results[date_str] = CANCEL_FREE
+            elif booking["user_id"] != user_id:
+                results[date_str] = CANCEL_NOT_YOURS
+            else:
+                results[date_str] = CANCEL_CANCELLED
+                owned.append((date_str,))
+        c.executemany("DELETE FROM bookings WHERE date = ?", owned)
+        _count_bookings(c, removed=[_booking_row(date_str, current[date_str]) for (date_str,) in owned])
+    for (date_str,) in owned:
+        _cancelled(shard, date_str, user_id, current[date_str]["username"])
+    return results
+
+# {date: CANCEL_*} для каждой даты
+async def cancel_bookings(dates, user_id: int, tenant=None):
+    shard = _shard(tenant)
+    return await shard.run(_cancel_bookings_sync, shard, list(dates), user_id)
+
+# --- Архивация прошедших броней ---
+# Каждая пачка — отдельная транзакция и отдельная задача потока БД,
+# поэтому между пачками успевают выполняться обычные запросы бота
+def _archive_batch_sync(conn, before_str: str, batch_size: int) -> int:
+    with _transaction(conn) as c:
+        c.execute(
+            "SELECT date, user_id, username, is_sponsor FROM bookings WHERE date < ? ORDER BY date LIMIT ?",
+            (before_str, batch_size)
+        )
+        rows = c.fetchall()
+        if not rows:
+            return 0
+        archived_at = time.time()
+        c.executemany('''
+            INSERT OR REPLACE INTO bookings_archive (date, user_id, username, is_sponsor, archived_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(*row, archived_at) for row in rows])
+        c.execute("DELETE FROM bookings WHERE date <= ?", (rows[-1][0],))
+    return len(rows)
+
+def _maintain_sync(conn):
+    # Файлы, созданные до включения auto_vacuum, переводим один раз полным VACUUM
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    freed = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute("PRAGMA incremental_vacuum").fetchall()
+    conn.execute("ANALYZE")
+    return {"pages_freed": freed, "bookings": conn.execute("SELECT COUNT(*) FROM bookings").fetchone()[0]}
+
+# Переносит брони раньше before_str в bookings_archive и обслуживает файл календаря.
+# Возвращает {"archived": N, "pages_freed": N, "bookings": N}
+async def archive_bookings(before_str: str, batch_size: int = ARCHIVE_BATCH_SIZE, tenant=None):
+    shard = _shard(tenant)
+    archived = 0
+    while True:
+        moved = await shard.run(_archive_batch_sync, before_str, batch_size)
+        archived += moved
+        if moved < batch_size:
+            break
+    report = await shard.run(_maintain_sync)
+    return {"archived": archived, **report}
+
+
+# --- Отчёты ---
+def _get_user_bookings_sync(conn, user_id: int, from_str: str):
     c = conn.cursor()
-    c.execute("DELETE FROM bookings WHERE date = ?", (date_str,))
-    conn.commit()
-    conn.close()
+    c.execute(
+        "SELECT date, is_sponsor FROM bookings WHERE user_id = ? AND date >= ? ORDER BY date",
+        (user_id, from_str)
+    )
+    return [{"date": row[0], "is_sponsor": bool(row[1])} for row in c.fetchall()]
+
+# Брони пользователя начиная с from_str, по возрастанию даты
+async def get_user_bookings(user_id: int, from_str: str, tenant=None):
+    return await _shard(tenant).run(_get_user_bookings_sync, user_id, from_str)
+
+def _get_occupancy_sync(conn, months, top_users: int):
+    c = conn.cursor()
+    c.execute('''
+        SELECT user_id, username, days, sponsor_days FROM user_booking_stats
+        WHERE days > 0 ORDER BY days DESC LIMIT ?
+    ''', (top_users,))
+    users = [
+        {"user_id": row[0], "username": row[1], "days": row[2], "sponsor_days": row[3]}
+        for row in c.fetchall()
+    ]
+    c.execute("SELECT days, sponsor_days FROM booking_totals WHERE id = 1")
+    days, sponsor_days = c.fetchone()
+    placeholders = ",".join("?" * len(months))
+    c.execute(
+        f"SELECT month, days, sponsor_days FROM month_booking_stats WHERE month IN ({placeholders})",
+        list(months)
+    )
+    by_month = {row[0]: {"days": row[1], "sponsor_days": row[2]} for row in c.fetchall()}
+    return {
+        "users": users,
+        "days": days,
+        "sponsor_days": sponsor_days,
+        "months": {month: by_month.get(month, {"days": 0, "sponsor_days": 0}) for month in months},
+    }
+
+# Сводка занятости из счётчиков: топ пользователей по дням, итоги и дни по месяцам ("YYYY-MM")
+async def get_occupancy(months, top_users: int = 10, tenant=None):
+    return await _shard(tenant).run(_get_occupancy_sync, list(months), top_users)
+
+def _get_audit_log_sync(conn, tenant, before_id, limit: int):
+    chat_id, thread_id = tenant if tenant is not None else (None, None)
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, ts, action, date, user_id, username, previous_user_id, previous_username
+        FROM audit_log
+        WHERE chat_id IS ? AND thread_id IS ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (chat_id, thread_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+    return [
+        {
+            "id": row[0],
+            "ts": row[1],
+            "action": row[2],
+            "date": row[3],
+            "user_id": row[4],
+            "username": row[5],
+            "previous_user_id": row[6],
+            "previous_username": row[7],
+        }
+        for row in c.fetchall()
+    ]
+
+# Страница журнала аудита календаря, новые события первыми; before_id — курсор
+# (id последнего события предыдущей страницы). Перед чтением дожидается записи очереди.
+async def get_audit_log(tenant=None, before_id: int = None, limit: int = 10):
+    if tenant is None:
+        tenant = _default_tenant
+    marker = _audit_writer().flush_marker()
+    await asyncio.get_running_loop().run_in_executor(None, marker.wait, AUDIT_FLUSH_INTERVAL * 10)
+    return await _main().run(_get_audit_log_sync, tenant, before_id, limit)
 
-async def cancel_booking(date_str: str):
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, _cancel_booking_sync, date_str)
+def audit_stats():
+    writer = _audit_writer()
+    return {"written": writer.written, "pending": writer.pending()}
 
-def _get_user_id_by_username_sync(username: str):
-    conn = sqlite3.connect(DB_PATH)
+def _get_user_id_by_username_sync(conn, username: str):
     c = conn.cursor()
     c.execute("SELECT user_id FROM users WHERE username = ? COLLATE NOCASE", (username,))
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
 async def get_user_id_by_username(username: str):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, _get_user_id_by_username_sync, username)
\ No newline at end of file
+    return await _main().run(_get_user_id_by_username_sync, username)
@@ -0,0 +1,127 @@
+# httpd.py
+# Минимальный HTTP/1.1-сервер на asyncio для служебных эндпоинтов (метрики, вебхук).
+# Один запрос на соединение; при остановке дожидается обработки начатых запросов.
+import asyncio
+import logging
+from http import HTTPStatus
+
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+READ_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class HttpError(Exception):
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers  # имена заголовков в нижнем регистре
+        self.body = body
+
+
+class Response:
+    def __init__(self, status: int = 200, body: bytes = b"", content_type: str = "text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        raise HttpError(400)
+    except asyncio.LimitOverrunError:
+        raise HttpError(431)
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _version = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HttpError(400)
+    if length < 0:
+        raise HttpError(400)
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), target.split("?", 1)[0], headers, body)
+
+
+def encode_response(response: Response) -> bytes:
+    status = HTTPStatus(response.status)
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: {response.content_type}\r\n"
+        f"Content-Length: {len(response.body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("latin-1") + response.body
+
+
+class HttpServer:
+    # handler: async (Request) -> Response
+    def __init__(self, handler, host: str, port: int):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self._server = None
+        self._in_flight = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=MAX_HEADER_SIZE
+        )
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self, drain_timeout: float = 10):
+        if self._server is None:
+            return
+        # Перестаём принимать соединения и даём начатым запросам завершиться
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        if self._in_flight:
+            _done, pending = await asyncio.wait(set(self._in_flight), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        try:
+            try:
+                request = await asyncio.wait_for(read_request(reader), READ_TIMEOUT)
+                response = await self.handler(request)
+            except HttpError as e:
+                response = Response(e.status)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                response = Response(408)
+            except Exception:
+                logger.exception("http handler failed")
+                response = Response(500)
+            writer.write(encode_response(response))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._in_flight.discard(task)
+            writer.close()
@@ -0,0 +1,27 @@
+# locks.py
+# Блокировки по ключу (дата, user_id) для параллельной обработки апдейтов.
+# Замок живёт, пока его кто-то держит или ждёт: словарь хранит слабые ссылки,
+# поэтому ключи без активности не накапливаются.
+import asyncio
+import weakref
+
+
+class KeyedLocks:
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+
+# Изменения брони одной даты
+date_locks = KeyedLocks()
+# Изменения профиля одного пользователя
+user_locks = KeyedLocks()
@@ -1,40 +1,202 @@
 # bot.py
 import os
+import asyncio
+import calendar
 import logging
-from datetime import date, timedelta
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from datetime import date, datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import TelegramError
+from telegram.ext import (
+    Application, CommandHandler, CallbackQueryHandler, TypeHandler, ApplicationHandlerStop, ContextTypes
+)
 from db import (
-    init_db, get_user, ensure_user, set_sponsor_status,
-    get_booking, set_booking, cancel_booking, get_user_id_by_username
+    AUDIT_BOOK, AUDIT_REPLACE, AUDIT_CANCEL,
+    BOOKING_BOOKED, BOOKING_ALREADY_YOURS, BOOKING_REJECTED_SPONSOR, BOOKING_TAKEN, BOOKING_REPLACED,
+    CANCEL_CANCELLED, CANCEL_NOT_YOURS
 )
+from storage import create_storage
+from locks import date_locks, user_locks
+from outbox import Outbox
+from throttle import CallbackThrottle, DUPLICATE
+from recorder import UpdateRecorder
+from webhook import run_webhook
+from metrics import metrics, timed_handler, log_sampled, render_stats, create_metrics_server, InstrumentedRequest
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SUPER_ADMIN_ID = int(os.getenv("SUPER_ADMIN_ID"))
-ALLOWED_CHAT_ID = int(os.getenv("ALLOWED_CHAT_ID"))
-ALLOWED_THREAD_ID = int(os.getenv("ALLOWED_THREAD_ID"))
+
+def parse_topics(value: str):
+    # "chat_id:thread_id,chat_id:thread_id"; без ":thread_id" — чат без топиков
+    topics = []
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        chat_id, _, thread_id = item.partition(":")
+        topics.append((int(chat_id), int(thread_id) if thread_id else None))
+    return topics
+
+# Календари (chat_id, thread_id), которые обслуживает бот. Первый — календарь по умолчанию,
+# его брони остаются в основной базе. ALLOWED_CHAT_ID/ALLOWED_THREAD_ID — прежняя настройка одного топика.
+if os.getenv("ALLOWED_CHAT_ID"):
+    DEFAULT_TENANT = (int(os.getenv("ALLOWED_CHAT_ID")), int(os.getenv("ALLOWED_THREAD_ID")))
+    ALLOWED_TOPICS = [DEFAULT_TENANT] + [t for t in parse_topics(os.getenv("ALLOWED_TOPICS", "")) if t != DEFAULT_TENANT]
+else:
+    ALLOWED_TOPICS = parse_topics(os.getenv("ALLOWED_TOPICS", ""))
+    DEFAULT_TENANT = ALLOWED_TOPICS[0]
+ALLOWED_TENANTS = frozenset(ALLOWED_TOPICS)
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Проверяется в каждом запросе вебхука; без него нужен WEBHOOK_URL (секрет сгенерируется, см. webhook.py)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Публичный адрес для setWebhook; без него сервер только слушает локально
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Локальный эндпоинт Prometheus (/metrics) включается, если задан порт
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Сколько месяцев вперёд можно листать календарь (страница = месяц, 0 — текущий)
+CALENDAR_MONTHS_AHEAD = 12
+# Сколько отрисованных страниц календаря держать в памяти (по всем календарям)
+CALENDAR_CACHE_SIZE = 64
+# Максимальная длина диапазона для пакетной брони/отмены, дней
+MAX_RANGE_DAYS = 14
+# Сколько открытых календарей на календарь-тенант обновлять при изменении броней
+MAX_TRACKED_CALENDARS = 20
+# Пауза перед обновлением открытых календарей: серия броней даёт одно обновление
+CALENDAR_REFRESH_DELAY = 0.5
+# Сколько апдейтов обрабатывается параллельно (изменения броней защищены блокировками по дате)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# Перенос прошедших броней в архив (JobQueue): период и задержка первого запуска, секунды
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", str(24 * 3600)))
+ARCHIVE_FIRST_DELAY = 60
+# Ответы на нажатия заранее не притормаживаются (только RetryAfter от Telegram);
+# OUTBOX_EDIT_RATE > 0 ограничивает их правками в секунду на чат (см. outbox.py)
+OUTBOX_EDIT_RATE = float(os.getenv("OUTBOX_EDIT_RATE", "0"))
+OUTBOX_EDIT_BURST = int(os.getenv("OUTBOX_EDIT_BURST", "10"))
+# Хранилище: sqlite (по умолчанию) или memory (см. storage.py)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+# Запись обезличенных апдейтов в JSONL для replay.py (см. recorder.py); выключена, если путь не задан
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")
+RECORD_SALT = os.getenv("RECORD_SALT")
 logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+storage = create_storage(STORAGE_BACKEND)
+recorder = UpdateRecorder(RECORD_UPDATES, RECORD_SALT) if RECORD_UPDATES else None
+
+metrics_server = None
 
-def in_allowed_topic(update: Update) -> bool:
+def tenant_of(update: Update):
     msg = update.effective_message
-    print(msg)
-    return bool(msg and msg.chat_id == ALLOWED_CHAT_ID and msg.message_thread_id == ALLOWED_THREAD_ID)
+    if msg is None:
+        return None
+    return msg.chat_id, msg.message_thread_id
+
+# Фильтр уровня диспетчера (группа -2): чужие апдейты отбрасываются до запуска обработчиков
+async def drop_foreign_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(update)
+    log_sampled(
+        logger, "update",
+        chat_id=tenant[0] if tenant else None,
+        thread_id=tenant[1] if tenant else None,
+        update_id=update.update_id,
+    )
+    if tenant not in ALLOWED_TENANTS:
+        raise ApplicationHandlerStop
+
+# Второй фильтр (группа -1): повторные и слишком частые нажатия кнопок
+# получают только ответ на callback, без БД и правки сообщения
+callback_throttle = CallbackThrottle()
 
-def get_dates_in_month():
+async def throttle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    message = query.message
+    verdict = callback_throttle.check(
+        query.from_user.id,
+        message.chat_id if message else None,
+        message.message_id if message else None,
+        query.data,
+    )
+    if verdict is None:
+        return
+    metrics.inc("bot_callbacks_throttled_total", reason=verdict)
+    try:
+        await query.answer(None if verdict == DUPLICATE else "⏳ Слишком часто, подождите секунду.")
+    except TelegramError:
+        pass  # Запрос мог устареть — нажатие всё равно отбрасываем
+    raise ApplicationHandlerStop
+
+# Имя в профиле: одно правило для всех обработчиков, иначе каждое нажатие
+# меняет сохранённое имя и кэш профилей не избавляет от записи
+def profile_name(user) -> str:
+    return user.username or user.full_name
+
+# ensure_user под блокировкой пользователя: параллельные нажатия одного человека
+# не пишут профиль одновременно
+async def ensure_profile(user):
+    async with user_locks.get(user.id):
+        return await storage.ensure_user(user.id, profile_name(user))
+
+MONTH_NAMES = [
+    "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+    "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь",
+]
+
+def page_month(page: int):
     today = date.today()
+    months = today.year * 12 + today.month - 1 + page
+    return months // 12, months % 12 + 1
 
-    return [today + timedelta(days=i) for i in range(30)]
+# Страница календаря, на которой находится дата
+def page_of(d: date) -> int:
+    today = date.today()
+    page = (d.year - today.year) * 12 + d.month - today.month
+    return min(max(page, 0), CALENDAR_MONTHS_AHEAD - 1)
+
+def get_dates_in_month(page: int = 0):
+    today = date.today()
+    year, month = page_month(page)
+    d = max(today, date(year, month, 1))
+    dates = []
+    while d.month == month:
+        dates.append(d)
+        d += timedelta(days=1)
+    return dates
+
+def calendar_text(page: int) -> str:
+    year, month = page_month(page)
+    return f"📅 {MONTH_NAMES[month - 1]} {year}. Выберите дату:"
 
 # --- Генерация клавиатуры календаря (выносим в отдельную функцию) ---
-async def build_calendar_keyboard():
+# Страница (месяц) строится лениво одним запросом броней за месяц и кэшируется по
+# (сегодняшняя дата, версия броней) — перестраивается только после изменения броней
+# или смены дня. Кэш ограничен CALENDAR_CACHE_SIZE страницами, вытесняются давно не открытые.
+_calendar_cache = OrderedDict()  # (tenant, page) -> (ключ, разметка)
+_prefetching = set()
+_background_tasks = set()
+
+async def build_calendar_keyboard(tenant=None, page: int = 0):
+    # Версию читаем до загрузки броней: запись между ними лишь вызовет лишнюю перестройку
+    key = (date.today(), storage.bookings_version(tenant))
+    cached = _calendar_cache.get((tenant, page))
+    if cached is not None and cached[0] == key:
+        _calendar_cache.move_to_end((tenant, page))
+        return cached[1]
+
+    dates = get_dates_in_month(page)
+    # Все брони месяца одним запросом вместо запроса на каждую дату
+    bookings = await storage.get_bookings_between(dates[0].isoformat(), dates[-1].isoformat(), tenant)
     keyboard = []
     row = []
-    for d in get_dates_in_month():
+    for d in dates:
         d_str = d.isoformat()
-        booking = await get_booking(d_str)
+        booking = bookings.get(d_str)
         is_booked = booking is not None
         is_sponsor_booking = booking["is_sponsor"] if booking else False
         emoji = "👑" if is_sponsor_booking else "❌" if is_booked else "📅"
@@ -44,43 +206,132 @@ async def build_calendar_keyboard():
             row = []
     if row:
         keyboard.append(row)
-    return InlineKeyboardMarkup(keyboard)
 
+    # Навигация по месяцам
+    nav = []
+    if page > 0:
+        _, prev_month = page_month(page - 1)
+        nav.append(InlineKeyboardButton(f"⬅️ {MONTH_NAMES[prev_month - 1]}", callback_data=f"cal_{page - 1}"))
+    if page < CALENDAR_MONTHS_AHEAD - 1:
+        _, next_month = page_month(page + 1)
+        nav.append(InlineKeyboardButton(f"{MONTH_NAMES[next_month - 1]} ➡️", callback_data=f"cal_{page + 1}"))
+    if nav:
+        keyboard.append(nav)
+
+    markup = InlineKeyboardMarkup(keyboard)
+    _calendar_cache[(tenant, page)] = (key, markup)
+    _calendar_cache.move_to_end((tenant, page))
+    while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+        _calendar_cache.popitem(last=False)
+    return markup
+
+async def _prefetch_calendar_page(tenant, page: int):
+    try:
+        await build_calendar_keyboard(tenant, page)
+    except Exception:
+        logger.exception("calendar prefetch failed")
+    finally:
+        _prefetching.discard((tenant, page))
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not in_allowed_topic(update):
+# Следующая страница готовится в фоне, пока пользователь смотрит текущую
+def prefetch_calendar_page(tenant, page: int):
+    if not 0 <= page < CALENDAR_MONTHS_AHEAD or (tenant, page) in _prefetching:
         return
-    user = update.effective_user
-    await ensure_user(user.id, user.username or user.full_name)
+    _prefetching.add((tenant, page))
+    task = asyncio.create_task(_prefetch_calendar_page(tenant, page))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+# Календарь + кнопка "Закрыть" для автора (единственная часть, зависящая от пользователя)
+async def build_calendar_markup(user_id: int, tenant=None, page: int = 0):
+    calendar_markup = await build_calendar_keyboard(tenant, page)
+    prefetch_calendar_page(tenant, page + 1)
+    close_button = InlineKeyboardButton("🗑️ Закрыть", callback_data=f"close_{user_id}")
+    return InlineKeyboardMarkup(calendar_markup.inline_keyboard + ((close_button,),))
+
+
+# --- Исходящие правки и живое обновление открытых календарей ---
+# Все правки сообщений идут через очередь outbox: она сливает правки одного сообщения
+# и соблюдает лимиты Telegram. Бот помнит последние MAX_TRACKED_CALENDARS сообщений
+# с календарём в каждом топике и после изменения броней перерисовывает их сам.
+_open_calendars = {}  # tenant -> OrderedDict{(chat_id, message_id): (page, owner_id, version)}
+_refresh_scheduled = set()
+
+def track_calendar(tenant, chat_id: int, message_id: int, page: int, owner_id: int, version: int):
+    calendars = _open_calendars.setdefault(tenant, OrderedDict())
+    calendars[(chat_id, message_id)] = (page, owner_id, version)
+    calendars.move_to_end((chat_id, message_id))
+    while len(calendars) > MAX_TRACKED_CALENDARS:
+        calendars.popitem(last=False)
+
+def untrack_calendar(chat_id: int, message_id: int):
+    for calendars in _open_calendars.values():
+        calendars.pop((chat_id, message_id), None)
+
+def on_edit_failed(chat_id: int, message_id: int, error: Exception):
+    # Сообщение удалено или недоступно — больше его не обновляем
+    untrack_calendar(chat_id, message_id)
+
+outbox = Outbox(edit_rate=OUTBOX_EDIT_RATE, edit_burst=OUTBOX_EDIT_BURST, on_error=on_edit_failed)
+
+# Правка сообщения с кнопкой, на которую нажали (через очередь, без ожидания отправки)
+def edit_message(update: Update, text: str, **kwargs):
+    message = update.callback_query.message
+    untrack_calendar(message.chat_id, message.message_id)
+    outbox.edit(message.chat_id, message.message_id, text, **kwargs)
+
+async def show_calendar(update: Update, user_id: int, page: int):
+    message = update.callback_query.message
+    tenant = tenant_of(update)
+    version = storage.bookings_version(tenant)
+    reply_markup = await build_calendar_markup(user_id, tenant, page)
+    outbox.edit(message.chat_id, message.message_id, calendar_text(page), reply_markup=reply_markup)
+    track_calendar(tenant, message.chat_id, message.message_id, page, user_id, version)
+
+async def _refresh_calendars(tenant):
+    await asyncio.sleep(CALENDAR_REFRESH_DELAY)
+    _refresh_scheduled.discard(tenant)
+    calendars = _open_calendars.get(tenant, {})
+    for (chat_id, message_id), (page, owner_id, shown_version) in list(calendars.items()):
+        version = storage.bookings_version(tenant)
+        if shown_version == version:
+            continue
+        reply_markup = await build_calendar_markup(owner_id, tenant, page)
+        if (chat_id, message_id) in calendars:  # пока строили, сообщение могли переключить
+            outbox.edit(chat_id, message_id, calendar_text(page), background=True, reply_markup=reply_markup)
+            calendars[(chat_id, message_id)] = (page, owner_id, version)
+
+# Вызывается после изменения броней
+def schedule_calendar_refresh(tenant):
+    if tenant in _refresh_scheduled or not _open_calendars.get(tenant):
+        return
+    _refresh_scheduled.add(tenant)
+    task = asyncio.create_task(_refresh_calendars(tenant))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-    # Получаем клавиатуру как список списков
-    calendar_keyboard = await build_calendar_keyboard()
-    # keyboard — это список списков кнопок
-    keyboard = [row[:] for row in calendar_keyboard.inline_keyboard]  # делаем копию как список
 
-    # Добавляем кнопку "Закрыть" для автора
-    close_button = InlineKeyboardButton("🗑️ Закрыть", callback_data=f"close_{user.id}")
-    keyboard.append([close_button])
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await ensure_profile(user)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("📅 Выберите дату:", reply_markup=reply_markup)
+    tenant = tenant_of(update)
+    version = storage.bookings_version(tenant)
+    reply_markup = await build_calendar_markup(user.id, tenant)
+    message = await update.message.reply_text(calendar_text(0), reply_markup=reply_markup)
+    track_calendar(tenant, message.chat_id, message.message_id, 0, user.id, version)
 
 async def handle_date_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if not in_allowed_topic(update):
-        # await query.message.reply_text("❌ Бот доступен только в определённом топике.")
-        return
-
     user = query.from_user
-    await ensure_user(user.id, user.username or f"user{user.id}")
-    user_data = await get_user(user.id)
+    user_data = await ensure_profile(user)
     is_sponsor = user_data["is_sponsor"]
 
     date_str = query.data[5:]  # "book_YYYY-MM-DD"
     target_date = date.fromisoformat(date_str)
-    booking = await get_booking(date_str)
+    booking = await storage.get_booking(date_str, tenant_of(update))
 
     # Формируем текст
     if booking:
@@ -110,39 +361,175 @@ async def handle_date_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     if booking and booking["user_id"] == user.id:
         buttons.append(InlineKeyboardButton("🗑️ Отказаться от брони", callback_data=f"cancel_{date_str}"))
 
-    buttons.append(InlineKeyboardButton("⬅️ Назад к календарю", callback_data="back_calendar"))
+    buttons.append(InlineKeyboardButton("📆 Диапазон с этой даты", callback_data=f"range_{date_str}"))
+    buttons.append(InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(target_date)}"))
 
     # Разбиваем кнопки по строкам (макс 2 в строке для читаемости)
     keyboard = []
     for i in range(0, len(buttons), 2):
         keyboard.append(buttons[i:i+2])
 
-    await query.edit_message_text(
+    edit_message(
+        update,
         text,
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode="HTML"
     )
 
-# --- Обработка кнопки "Назад к календарю" ---
-async def back_to_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- Диапазон дат: выбор конца, затем пакетная бронь или отмена одной транзакцией ---
+def parse_range(data: str, prefix: str):
+    # "<prefix>YYYY-MM-DD_YYYY-MM-DD" -> список дат или None, если диапазон некорректен
+    try:
+        start_str, end_str = data[len(prefix):].split("_")
+        start_date, end_date = date.fromisoformat(start_str), date.fromisoformat(end_str)
+    except ValueError:
+        return None
+    days = (end_date - start_date).days + 1
+    if not 1 <= days <= MAX_RANGE_DAYS:
+        return None
+    return [start_date + timedelta(days=i) for i in range(days)]
+
+def range_title(dates) -> str:
+    return f"📆 <b>{dates[0].strftime('%d.%m.%Y')} – {dates[-1].strftime('%d.%m.%Y')}</b> ({len(dates)} дн.)"
+
+# Блокировки всех дат диапазона берутся в порядке дат, чтобы пересекающиеся диапазоны не ждали друг друга по кругу
+async def lock_dates(stack: AsyncExitStack, tenant, dates):
+    for d in sorted(dates):
+        await stack.enter_async_context(date_locks.get((tenant, d.isoformat())))
+
+async def range_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if not in_allowed_topic(update):
+    start_str = query.data[6:]  # "range_YYYY-MM-DD"
+    start_date = date.fromisoformat(start_str)
+
+    buttons = [
+        InlineKeyboardButton(d.strftime('%d.%m'), callback_data=f"rng_{start_str}_{d.isoformat()}")
+        for d in (start_date + timedelta(days=i) for i in range(1, MAX_RANGE_DAYS))
+    ]
+    keyboard = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"book_{start_str}")])
+
+    edit_message(
+        update,
+        f"📆 Начало: <b>{start_date.strftime('%d.%m.%Y')}</b>\n\nВыберите последний день диапазона:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+
+async def range_select_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    dates = parse_range(query.data, "rng_")
+    if dates is None:
+        edit_message(update, "❌ Некорректный диапазон.")
+        return
+    suffix = f"{dates[0].isoformat()}_{dates[-1].isoformat()}"
+
+    edit_message(
+        update,
+        f"{range_title(dates)}\n\nЧто сделать со всеми датами диапазона?",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Забронировать все", callback_data=f"brange_{suffix}")],
+            [InlineKeyboardButton("🗑️ Отменить мои брони", callback_data=f"crange_{suffix}")],
+            [InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(dates[0])}")],
+        ]),
+        parse_mode="HTML"
+    )
+
+async def range_book_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    dates = parse_range(query.data, "brange_")
+    if dates is None:
+        edit_message(update, "❌ Некорректный диапазон.")
+        return
+
+    user = query.from_user
+    user_data = await ensure_profile(user)
+    is_sponsor = user_data["is_sponsor"]
+    username = user.username or f"user{user.id}"
+
+    tenant = tenant_of(update)
+    async with AsyncExitStack() as stack:
+        await lock_dates(stack, tenant, dates)
+        results = await storage.set_bookings([d.isoformat() for d in dates], user.id, username, is_sponsor, tenant)
+
+    lines = []
+    for d in dates:
+        result = results[d.isoformat()]
+        status, previous = result["status"], result["previous"]
+        if status == BOOKING_BOOKED:
+            line = ("👑" if is_sponsor else "✅") + " забронировано"
+        elif status == BOOKING_REPLACED:
+            line = "👑 передано вам"
+        elif status == BOOKING_ALREADY_YOURS:
+            line = "☑️ уже ваша"
+        elif status == BOOKING_REJECTED_SPONSOR:
+            line = f"❌ занято спонсором @{previous['username']}"
+        else:
+            line = "❌ занято"
+        lines.append(f"{d.strftime('%d.%m')} — {line}")
+    booked = sum(results[d.isoformat()]["status"] in (BOOKING_BOOKED, BOOKING_REPLACED) for d in dates)
+    if booked:
+        schedule_calendar_refresh(tenant)
+
+    edit_message(
+        update,
+        f"{range_title(dates)}\n\nЗабронировано: {booked} из {len(dates)}\n\n" + "\n".join(lines),
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(dates[0])}")
+        ]]),
+        parse_mode="HTML"
+    )
+
+async def range_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    dates = parse_range(query.data, "crange_")
+    if dates is None:
+        edit_message(update, "❌ Некорректный диапазон.")
         return
 
     user = query.from_user
+    tenant = tenant_of(update)
+    async with AsyncExitStack() as stack:
+        await lock_dates(stack, tenant, dates)
+        results = await storage.cancel_bookings([d.isoformat() for d in dates], user.id, tenant)
+
+    labels = {
+        CANCEL_CANCELLED: "✅ отменено",
+        CANCEL_NOT_YOURS: "🚫 чужая бронь",
+    }
+    lines = [f"{d.strftime('%d.%m')} — {labels.get(results[d.isoformat()], '▫️ свободна')}" for d in dates]
+    cancelled = sum(status == CANCEL_CANCELLED for status in results.values())
+    if cancelled:
+        schedule_calendar_refresh(tenant)
+
+    edit_message(
+        update,
+        f"{range_title(dates)}\n\nОтменено ваших броней: {cancelled}\n\n" + "\n".join(lines),
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(dates[0])}")
+        ]]),
+        parse_mode="HTML"
+    )
 
-    # Получаем клавиатуру календаря
-    calendar_markup = await build_calendar_keyboard()
-    keyboard = [row[:] for row in calendar_markup.inline_keyboard]  # делаем копию
+# --- Обработка кнопки "Назад к календарю" и листания месяцев ---
+async def back_to_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
-    # Добавляем кнопку "Закрыть" для автора
-    close_button = InlineKeyboardButton("🗑️ Закрыть", callback_data=f"close_{user.id}")
-    keyboard.append([close_button])
+    user = query.from_user
+    # "cal_N" — страница N; "back_calendar" (старые сообщения) — текущий месяц
+    page = int(query.data[4:]) if query.data.startswith("cal_") else 0
+    page = min(max(page, 0), CALENDAR_MONTHS_AHEAD - 1)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("📅 Выберите дату:", reply_markup=reply_markup)
+    await show_calendar(update, user.id, page)
 
 
 async def sponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -151,8 +538,6 @@ async def sponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if input_arg.startswith('@'):
         username = input_arg[1:]
 
-    if not in_allowed_topic(update):
-        return
     if update.effective_user.id != SUPER_ADMIN_ID:
         await update.message.reply_text("❌ Только супер-админ может выдавать спонсорство.")
         return
@@ -171,7 +556,7 @@ async def sponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Определяем тип: username или ID
     if input_arg.startswith('@'):
         username = input_arg[1:]
-        target_user_id = await get_user_id_by_username(username)
+        target_user_id = await storage.get_user_id_by_username(username)
         if target_user_id is None:
             await update.message.reply_text(
                 f"❌ Пользователь @{username} не найден в базе.\n"
@@ -185,7 +570,8 @@ async def sponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите @username.")
             return
 
-    await set_sponsor_status(target_user_id, True)
+    async with user_locks.get(target_user_id):
+        await storage.set_sponsor_status(target_user_id, True)
     await update.message.reply_text(f"✅ Пользователь {username} теперь спонсор!")
 
 
@@ -196,8 +582,6 @@ async def unsponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if input_arg.startswith('@'):
         username = input_arg[1:]
 
-    if not in_allowed_topic(update):
-        return
     if update.effective_user.id != SUPER_ADMIN_ID:
         await update.message.reply_text("❌ Только супер-админ может управлять спонсорством.")
         return
@@ -215,7 +599,7 @@ async def unsponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if input_arg.startswith('@'):
         username = input_arg[1:]
-        target_user_id = await get_user_id_by_username(username)
+        target_user_id = await storage.get_user_id_by_username(username)
         if target_user_id is None:
             await update.message.reply_text(
                 f"❌ Пользователь @{username} не найден в базе.\n"
@@ -229,73 +613,104 @@ async def unsponsor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Укажите @username или числовой ID.")
             return
 
-    await set_sponsor_status(target_user_id, False)
+    async with user_locks.get(target_user_id):
+        await storage.set_sponsor_status(target_user_id, False)
     await update.message.reply_text(f"❌ Спонсорство у пользователя {username} отозвано.")
 
+# --- Архивация прошедших броней ---
+last_archive_report = {}
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    global last_archive_report
+    today = date.today().isoformat()
+    totals = {"archived": 0, "pages_freed": 0, "bookings": 0}
+    for tenant in ALLOWED_TOPICS:
+        report = await storage.archive_bookings(today, tenant=tenant)
+        for key in totals:
+            totals[key] += report[key]
+        if report["archived"]:
+            logger.info("archived %d bookings of %s, %d left", report["archived"], tenant, report["bookings"])
+    last_archive_report = {"at": datetime.now().strftime("%d.%m %H:%M"), **totals}
+    logger.info("archive job: %s", last_archive_report)
+
+def schedule_archive(application: Application):
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]) — архивация отключена")
+        return
+    application.job_queue.run_repeating(
+        archive_job, interval=ARCHIVE_INTERVAL, first=ARCHIVE_FIRST_DELAY, name="archive_bookings"
+    )
+
 async def post_init(application: Application):
-    await init_db()
-    logging.info("✅ Бот запущен с SQLite (v20+).")
+    global metrics_server
+    await storage.init(DEFAULT_TENANT)
+    outbox.start(application.bot)
+    if recorder is not None:
+        recorder.open({
+            "super_admin_id": recorder.pseudonym(SUPER_ADMIN_ID),
+            "tenants": [list(tenant) for tenant in ALLOWED_TOPICS],
+        })
+    if METRICS_PORT:
+        metrics_server = create_metrics_server(METRICS_HOST, int(METRICS_PORT))
+        await metrics_server.start()
+    logging.info("✅ Бот запущен, хранилище: %s.", storage.name)
+
+# Отменяем фоновые перерисовки и отправляем накопленные правки, пока бот ещё не остановлен
+async def post_stop(application: Application):
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await outbox.stop()
+
+async def post_shutdown(application: Application):
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await storage.close()
+    if recorder is not None:
+        recorder.close()
 
 async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    # 🔒 Проверка топика
-    if not in_allowed_topic(update):
-        # await query.message.reply_text("❌ Бот доступен только в определённом топике.")
-        return
-
     user = query.from_user
-    await ensure_user(user.id, user.username or user.full_name)
-    user_data = await get_user(user.id)
+    user_data = await ensure_profile(user)
     is_sponsor = user_data["is_sponsor"]
     username = user.username or f"user{user.id}"
 
     date_str = query.data[8:]  # "confirm_YYYY-MM-DD"
     target_date = date.fromisoformat(date_str)
 
-    # Получаем актуальную бронь (на случай, если за это время изменилась)
-    booking = await get_booking(date_str)
-
-    message = ""
-    success = False
-
-    if booking:
-        if booking["user_id"] == user.id:
-            message = "❌ Вы уже забронировали этот день."
-        elif booking["is_sponsor"] and not is_sponsor:
-            message = f"❌ Дата занята спонсором @{booking['username']}. Обычные пользователи не могут её забронировать."
-        elif not booking["is_sponsor"] and is_sponsor:
-            # Спонсор перебронирует обычного
-            success = await set_booking(date_str, user.id, username, True)
-            if success:
-                message = f"👑 Спонсор! Бронь на {target_date.strftime('%d.%m.%Y')} передана вам."
-            else:
-                message = "⚠️ Ошибка при перебронировании."
-        elif booking["is_sponsor"] and is_sponsor:
-            # Спонсор перебронирует спонсора
-            success = await set_booking(date_str, user.id, username, True)
-            if success:
-                message = f"👑 Спонсор! Бронь на {target_date.strftime('%d.%m.%Y')} передана вам."
-            else:
-                message = "⚠️ Ошибка при перебронировании."
-        else:
-            # Например: обычный нажал на дату, занятую другим обычным (но это не должно происходить — кнопка не отображается)
-            message = "❌ Дата уже занята другим пользователем."
+    # Проверка актуальной брони и запись выполняются атомарно в set_booking
+    tenant = tenant_of(update)
+    async with date_locks.get((tenant, date_str)):
+        result = await storage.set_booking(date_str, user.id, username, is_sponsor, tenant)
+    status = result["status"]
+    previous = result["previous"]
+    if status in (BOOKING_BOOKED, BOOKING_REPLACED):
+        schedule_calendar_refresh(tenant)
+
+    if status == BOOKING_ALREADY_YOURS:
+        message = "❌ Вы уже забронировали этот день."
+    elif status == BOOKING_REJECTED_SPONSOR:
+        message = f"❌ Дата занята спонсором @{previous['username']}. Обычные пользователи не могут её забронировать."
+    elif status == BOOKING_TAKEN:
+        # Обычный нажал на дату, занятую другим обычным (кнопка не отображается, но бронь могла появиться позже)
+        message = "❌ Дата уже занята другим пользователем."
+    elif status == BOOKING_REPLACED:
+        # Спонсор перебронирует обычного или другого спонсора
+        message = f"👑 Спонсор! Бронь на {target_date.strftime('%d.%m.%Y')} передана вам."
     else:
-        # Дата свободна
-        success = await set_booking(date_str, user.id, username, is_sponsor)
-        if success:
-            mark = "👑" if is_sponsor else "❌"
-            message = f"{mark} Дата {target_date.strftime('%d.%m.%Y')} успешно забронирована!"
-        else:
-            message = "⚠️ Не удалось выполнить бронирование."
+        # Дата была свободна
+        mark = "👑" if is_sponsor else "❌"
+        message = f"{mark} Дата {target_date.strftime('%d.%m.%Y')} успешно забронирована!"
 
     # Отправляем результат
-    await query.edit_message_text(
+    edit_message(
+        update,
         f"📅 <b>{target_date.strftime('%d.%m.%Y')}</b>\n\n{message}",
         reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("⬅️ Назад к календарю", callback_data="back_calendar")
+            InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(target_date)}")
         ]]),
         parse_mode="HTML"
     )
@@ -304,44 +719,43 @@ async def cancel_booking_handler(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
 
-    if not in_allowed_topic(update):
-        # await query.message.reply_text("❌ Бот доступен только в определённом топике.")
-        return
-
     user = query.from_user
     date_str = query.data[7:]  # "cancel_YYYY-MM-DD"
     target_date = date.fromisoformat(date_str)
 
-    # Проверим, что бронь действительно принадлежит пользователю
-    booking = await get_booking(date_str)
-    if not booking or booking["user_id"] != user.id:
-        await query.edit_message_text(
+    # Проверка владельца и удаление под блокировкой даты: между ними никто не перебронирует
+    tenant = tenant_of(update)
+    async with date_locks.get((tenant, date_str)):
+        booking = await storage.get_booking(date_str, tenant)
+        is_owner = booking is not None and booking["user_id"] == user.id
+        if is_owner:
+            await storage.cancel_booking(date_str, tenant)
+    if is_owner:
+        schedule_calendar_refresh(tenant)
+
+    if not is_owner:
+        edit_message(
+            update,
             f"📅 <b>{target_date.strftime('%d.%m.%Y')}</b>\n\n❌ Вы не можете отменить чужую бронь.",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("⬅️ Назад к календарю", callback_data="back_calendar")
+                InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(target_date)}")
             ]])
         )
         return
 
-    # Удаляем бронь
-    await cancel_booking(date_str)
-
-    await query.edit_message_text(
+    edit_message(
+        update,
         f"📅 <b>{target_date.strftime('%d.%m.%Y')}</b>\n\n✅ Ваша бронь отменена. Дата теперь свободна.",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("⬅️ Назад к календарю", callback_data="back_calendar")
+            InlineKeyboardButton("⬅️ Назад к календарю", callback_data=f"cal_{page_of(target_date)}")
         ]])
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not in_allowed_topic(update):
-        # await update.message.reply_text("❌ Бот доступен только в определённом топике.")
-        return
-
     user = update.effective_user
-    user_data = await get_user(user.id)
+    user_data = await storage.get_user(user.id)
     is_super_admin = user_data["is_super_admin"]
     is_sponsor = user_data["is_sponsor"]
 
@@ -349,7 +763,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Общие команды
     help_text += "<b>Доступно всем:</b>\n"
-    help_text += "• /book — календарь бронирования. Отображает статус бронирования, даёт возможность занять дату или отказаться от неё.\n\n"
+    help_text += "• /book — календарь бронирования. Отображает статус бронирования, даёт возможность занять дату или отказаться от неё.\n"
+    help_text += f"• 📆 Диапазон в карточке даты — забронировать или отменить до {MAX_RANGE_DAYS} дней разом.\n"
+    help_text += "• /mybookings — ваши предстоящие брони.\n\n"
 
     # Права
     if is_sponsor:
@@ -364,6 +780,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text += "<b>Команды супер-админа:</b>\n"
         help_text += "• /sponsor @username — назначить спонсора\n"
         help_text += "• /unsponsor @username — отозвать спонсорство\n"
+        help_text += "• /stats — задержки обработчиков, БД и Telegram API\n"
+        help_text += "• /audit — история бронирований и отмен\n"
+        help_text += "• /occupancy — занятость по пользователям и месяцам\n"
 
     help_text += "<i>💡 Чтобы попасть в базу — пользователь должен хотя бы раз написать /book в этом топике.</i>\n"
 
@@ -371,6 +790,122 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode="HTML")
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != SUPER_ADMIN_ID:
+        await update.message.reply_text("❌ Только супер-админ может смотреть статистику.")
+        return
+
+    text = render_stats({
+        **storage.stats(),
+        "Очередь правок": outbox.stats(),
+        "Нажатия кнопок": callback_throttle.stats(),
+        **({"Запись апдейтов": recorder.stats()} if recorder is not None else {}),
+        "Архивация": last_archive_report or {"at": "ещё не запускалась"},
+    })
+    await update.message.reply_text(text, parse_mode="HTML")
+
+
+# --- Отчёты ---
+MY_BOOKINGS_LIMIT = 50
+# Месяцы отчёта занятости относительно текущего (страницы календаря)
+OCCUPANCY_PAGES = range(-2, 4)
+
+async def my_bookings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    bookings = await storage.get_user_bookings(user.id, date.today().isoformat(), tenant_of(update))
+    if not bookings:
+        await update.message.reply_text("📭 У вас нет предстоящих броней. Забронировать — /book")
+        return
+
+    lines = [f"📋 <b>Ваши брони</b> ({len(bookings)}):", ""]
+    for booking in bookings[:MY_BOOKINGS_LIMIT]:
+        d = date.fromisoformat(booking["date"])
+        lines.append(f"• {d.strftime('%d.%m.%Y')}{' 👑' if booking['is_sponsor'] else ''}")
+    if len(bookings) > MY_BOOKINGS_LIMIT:
+        lines.append(f"… и ещё {len(bookings) - MY_BOOKINGS_LIMIT}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+def percent(part: int, total: int) -> str:
+    return f"{part * 100 / total:.0f}%" if total else "—"
+
+async def occupancy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != SUPER_ADMIN_ID:
+        await update.message.reply_text("❌ Только супер-админ может смотреть отчёты.")
+        return
+
+    months = [page_month(page) for page in OCCUPANCY_PAGES]
+    report = await storage.get_occupancy([f"{year}-{month:02d}" for year, month in months], tenant=tenant_of(update))
+
+    lines = ["📈 <b>Занятость</b>", ""]
+    lines.append(
+        f"Всего дней: {report['days']}, из них спонсорских: {report['sponsor_days']} "
+        f"({percent(report['sponsor_days'], report['days'])})"
+    )
+    lines.append("")
+    lines.append("<b>По месяцам</b> (занято / дней, доля спонсоров):")
+    for (year, month), stats in zip(months, report["months"].values()):
+        days_in_month = calendar.monthrange(year, month)[1]
+        lines.append(
+            f"• {MONTH_NAMES[month - 1]} {year}: {stats['days']}/{days_in_month} "
+            f"({percent(stats['days'], days_in_month)}), 👑 {percent(stats['sponsor_days'], stats['days'])}"
+        )
+    if report["users"]:
+        lines.append("")
+        lines.append("<b>По пользователям</b> (дней, из них спонсорских):")
+        for user in report["users"]:
+            lines.append(f"• @{user['username']}: {user['days']} ({user['sponsor_days']} 👑)")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+# --- Журнал аудита ---
+AUDIT_PAGE_SIZE = 10
+AUDIT_ACTIONS = {
+    AUDIT_BOOK: "✅ бронь",
+    AUDIT_REPLACE: "👑 перебронь",
+    AUDIT_CANCEL: "🗑 отмена",
+}
+
+def audit_line(event) -> str:
+    when = datetime.fromtimestamp(event["ts"]).strftime("%d.%m %H:%M")
+    target = date.fromisoformat(event["date"]).strftime("%d.%m.%Y")
+    line = f"{when} {AUDIT_ACTIONS.get(event['action'], event['action'])} {target} — @{event['username']}"
+    if event["previous_username"]:
+        line += f" (была @{event['previous_username']})"
+    return line
+
+async def render_audit_page(tenant, before_id: int = None):
+    events = await storage.get_audit_log(tenant, before_id, AUDIT_PAGE_SIZE + 1)
+    has_more = len(events) > AUDIT_PAGE_SIZE
+    events = events[:AUDIT_PAGE_SIZE]
+    if not events:
+        return "📜 Журнал пуст.", None
+    text = "📜 <b>История бронирований</b>\n\n" + "\n".join(audit_line(e) for e in events)
+    markup = None
+    if has_more:
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("⬇️ Раньше", callback_data=f"audit_{events[-1]['id']}")
+        ]])
+    return text, markup
+
+async def audit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != SUPER_ADMIN_ID:
+        await update.message.reply_text("❌ Только супер-админ может смотреть журнал.")
+        return
+
+    text, markup = await render_audit_page(tenant_of(update))
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+
+async def audit_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id != SUPER_ADMIN_ID:
+        await query.answer("🔒 Только для супер-админа.", show_alert=True)
+        return
+    await query.answer()
+
+    text, markup = await render_audit_page(tenant_of(update), int(query.data.split("_")[1]))
+    edit_message(update, text, parse_mode="HTML", reply_markup=markup)
+
+
 async def close_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -385,24 +920,60 @@ async def close_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("🔒 Только автор может закрыть это сообщение.", show_alert=True)
         return
 
+    untrack_calendar(query.message.chat_id, query.message.message_id)
     try:
         await query.message.delete()
     except Exception:
         pass  # Игнорируем ошибки (уже удалено, нет прав и т.д.)
 
 
+# Приложение со всеми обработчиками. replay.py собирает его же с поддельным HTTP-клиентом
+def build_application(request=None, updater: bool = True) -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request or InstrumentedRequest())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    if recorder is not None:
+        # Раньше фильтров: записываются все входящие апдейты
+        app.add_handler(TypeHandler(Update, recorder.record), group=-3)
+    app.add_handler(TypeHandler(Update, drop_foreign_updates), group=-2)
+    app.add_handler(CallbackQueryHandler(throttle_callbacks), group=-1)
+    app.add_handler(CommandHandler("book", timed_handler(start)))
+    app.add_handler(CommandHandler("sponsor", timed_handler(sponsor_command)))
+    app.add_handler(CommandHandler("unsponsor", timed_handler(unsponsor_command)))
+    app.add_handler(CommandHandler("help", timed_handler(help_command)))
+    app.add_handler(CommandHandler("stats", timed_handler(stats_command)))
+    app.add_handler(CommandHandler("audit", timed_handler(audit_command)))
+    app.add_handler(CommandHandler("mybookings", timed_handler(my_bookings_command)))
+    app.add_handler(CommandHandler("occupancy", timed_handler(occupancy_command)))
+    app.add_handler(CallbackQueryHandler(timed_handler(handle_date_callback), pattern=r"^book_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(confirm_booking), pattern=r"^confirm_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(cancel_booking_handler), pattern=r"^cancel_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(range_start_handler), pattern=r"^range_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(range_select_handler), pattern=r"^rng_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(range_book_handler), pattern=r"^brange_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(range_cancel_handler), pattern=r"^crange_"))
+    app.add_handler(CallbackQueryHandler(timed_handler(back_to_calendar), pattern=r"^(back_calendar|cal_\d+)$"))
+    app.add_handler(CallbackQueryHandler(timed_handler(close_message_handler), pattern=r"^close_\d+$"))
+    app.add_handler(CallbackQueryHandler(timed_handler(audit_page_handler), pattern=r"^audit_\d+$"))
+    return app
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    app.add_handler(CommandHandler("book", start))
-    app.add_handler(CommandHandler("sponsor", sponsor_command))
-    app.add_handler(CommandHandler("unsponsor", unsponsor_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CallbackQueryHandler(handle_date_callback, pattern=r"^book_"))
-    app.add_handler(CallbackQueryHandler(confirm_booking, pattern=r"^confirm_"))
-    app.add_handler(CallbackQueryHandler(cancel_booking_handler, pattern=r"^cancel_"))
-    app.add_handler(CallbackQueryHandler(back_to_calendar, pattern=r"^back_calendar$"))
-    app.add_handler(CallbackQueryHandler(close_message_handler, pattern=r"^close_\d+$"))
-    app.run_polling()
+    # В режиме вебхука апдейты приходят через наш HTTP-сервер, Updater (long polling) не нужен
+    app = build_application(updater=BOT_MODE != "webhook")
+    schedule_archive(app)
+    if BOT_MODE == "webhook":
+        run_webhook(app, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL)
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,211 @@
+# metrics.py
+# Лёгкие метрики процесса: счётчики и гистограммы задержек обработчиков,
+# операций БД, вызовов Telegram API и ожидания правок в очереди (outbox.py).
+# Читаются командой /stats и (опционально) отдаются в текстовом формате
+# Prometheus на локальном порту METRICS_PORT.
+import os
+import time
+import random
+import logging
+import functools
+import threading
+
+from telegram.request import HTTPXRequest
+
+from httpd import HttpServer, Response
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Оценка перцентиля по корзинам: верхняя граница корзины, в которую он попал
+    def percentile(self, pct: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self._counters = {}    # (name, labels) -> число
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._lock = threading.Lock()  # операции БД отчитываются из потока SQLite
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    # Сбрасывает гистограммы метрики (бенчмарк меряет каждый сценарий отдельно)
+    def clear(self, name: str):
+        with self._lock:
+            for key in [key for key in self._histograms if key[0] == name]:
+                del self._histograms[key]
+
+    def counters(self, name: str):
+        with self._lock:
+            return {labels: value for (n, labels), value in self._counters.items() if n == name}
+
+    def histograms(self, name: str):
+        with self._lock:
+            return {labels: h for (n, labels), h in self._histograms.items() if n == name}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(_bucket_bounds(h), h.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {h.count}")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+
+def _bucket_bounds(histogram: Histogram):
+    return [str(b) for b in histogram.buckets] + ["+Inf"]
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+metrics = Metrics()
+
+
+# --- Инструментирование ---
+def timed_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+# Время ожидания потока БД и время выполнения операции (вызывается из db.py)
+def observe_db(operation: str, wait_seconds: float, run_seconds: float):
+    metrics.inc("bot_db_queries_total", op=operation)
+    metrics.observe("bot_db_executor_wait_seconds", wait_seconds)
+    metrics.observe("bot_db_query_seconds", run_seconds, op=operation)
+
+
+# HTTP-клиент бота, замеряющий время каждого вызова Telegram API
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.observe("bot_telegram_api_seconds", time.perf_counter() - started, method=api_method)
+
+
+# Структурный лог с выборкой: пишется примерно LOG_SAMPLE_RATE событий
+def log_sampled(log: logging.Logger, event: str, level: int = logging.DEBUG, **fields):
+    if not log.isEnabledFor(level) or random.random() >= LOG_SAMPLE_RATE:
+        return
+    log.log(level, "%s %s", event, " ".join(f"{k}={v}" for k, v in fields.items()))
+
+
+# --- Отчёт для /stats ---
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}"
+
+def _label(labels, key: str) -> str:
+    return dict(labels).get(key, "")
+
+def render_stats(extra: dict = None) -> str:
+    uptime = int(time.time() - metrics.started_at)
+    lines = [f"📊 <b>Статистика</b> (аптайм {uptime // 3600}ч {uptime % 3600 // 60}м)", ""]
+
+    sections = (
+        ("Обработчики", "bot_handler_seconds", "handler"),
+        ("Операции БД", "bot_db_query_seconds", "op"),
+        ("Telegram API", "bot_telegram_api_seconds", "method"),
+        ("Ожидание в очереди правок", "bot_outbox_wait_seconds", "lane"),
+    )
+    for title, name, label in sections:
+        histograms = metrics.histograms(name)
+        if not histograms:
+            continue
+        lines.append(f"<b>{title}</b> (n / p50 / p99 / max, мс):")
+        for labels, h in sorted(histograms.items(), key=lambda item: -item[1].count):
+            lines.append(
+                f"• {_label(labels, label)}: {h.count} / {_ms(h.percentile(50))} / "
+                f"{_ms(h.percentile(99))} / {_ms(h.max)}"
+            )
+        lines.append("")
+
+    wait = metrics.histograms("bot_db_executor_wait_seconds").get(())
+    if wait:
+        lines.append(f"<b>Ожидание потока БД:</b> p50 {_ms(wait.percentile(50))} мс, p99 {_ms(wait.percentile(99))} мс")
+    errors = metrics.counters("bot_handler_errors_total")
+    if errors:
+        lines.append("<b>Ошибки:</b> " + ", ".join(f"{_label(l, 'handler')}={v}" for l, v in errors.items()))
+    for title, stats in (extra or {}).items():
+        lines.append(f"<b>{title}:</b> " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    return "\n".join(lines).strip()
+
+
+# --- Эндпоинт Prometheus ---
+async def _metrics_endpoint(request):
+    if request.method != "GET" or request.path != "/metrics":
+        return Response(404)
+    return Response(200, metrics.render_prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+def create_metrics_server(host: str, port: int) -> HttpServer:
+    return HttpServer(_metrics_endpoint, host, port)
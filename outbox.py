@@ -0,0 +1,242 @@
+# outbox.py
+# Очередь исходящих правок сообщений. Несколько ожидающих правок одного сообщения
+# сливаются в одну (отправляется последняя), при RetryAfter правка откладывается
+# на указанное время.
+#
+# Две полосы на чат: ответы на нажатия (interactive) всегда идут первыми и заранее
+# не притормаживаются (только RetryAfter или, если задан, edit_rate). Фоновые правки
+# (обновление чужих открытых календарей) идут не быстрее лимитов Telegram и только
+# из свободного бюджета: ответы на нажатия тоже расходуют вёдра чата и бота, и пока
+# в ведре меньше резерва, фоновые правки ждут и сливаются с более новыми.
+# Время от постановки правки в очередь до отправки — гистограмма bot_outbox_wait_seconds.
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from metrics import metrics
+
+# Telegram: не больше ~20 сообщений в минуту в группу и ~30 в секунду на бота
+CHAT_RATE = 20 / 60
+CHAT_BURST = 20
+GLOBAL_RATE = 30
+# Ответы на нажатия в одном чате, правок в секунду; 0 — без ограничения (только RetryAfter)
+EDIT_RATE = 0
+EDIT_BURST = 10
+STOP_TIMEOUT = 10
+# Жетоны ведра чата, которые фоновые правки не трогают: столько ответов на нажатия
+# уложится в лимит Telegram даже сразу после серии обновлений календарей
+CHAT_BACKGROUND_RESERVE = 5
+GLOBAL_BACKGROUND_RESERVE = 10
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько ждать, пока жетон можно взять, оставив в ведре reserve (0 — можно сейчас)
+    def wait_time(self, reserve: float = 0) -> float:
+        self._refill()
+        needed = 1 + min(reserve, self.capacity - 1)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    # Жетон без ожидания: ведро может уйти в долг, но не глубже своей ёмкости
+    def take_now(self):
+        self._refill()
+        self.tokens = max(self.tokens - 1, -self.capacity)
+
+
+class Outbox:
+    # on_error(chat_id, message_id, error) — правка не удалась (сообщение удалено, нет прав и т.д.)
+    def __init__(self, chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 global_rate: float = GLOBAL_RATE, on_error=None,
+                 chat_reserve: float = CHAT_BACKGROUND_RESERVE, global_reserve: float = GLOBAL_BACKGROUND_RESERVE,
+                 edit_rate: float = EDIT_RATE, edit_burst: float = EDIT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.edit_rate = edit_rate
+        self.edit_burst = edit_burst
+        self.chat_reserve = chat_reserve
+        self.global_reserve = global_reserve
+        self.on_error = on_error
+        self.bot = None
+        self.sent = 0
+        self.sent_background = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._edit_buckets = {}
+        self._pending = {}     # (chat_id, message_id) -> (аргументы последней правки, фоновая ли, поставлена в очередь)
+        self._queues = {}      # chat_id -> deque[(chat_id, message_id)] ответов на нажатия
+        self._background = {}  # chat_id -> deque[(chat_id, message_id)] фоновых правок
+        self._wakeups = {}     # chat_id -> Event: пришла правка, пока фоновая ждёт бюджета
+        self._workers = {}     # chat_id -> задача, отправляющая правки этого чата
+
+    def start(self, bot):
+        self.bot = bot
+
+    # background=True — правка не в ответ на действие пользователя: уступает очередь
+    # интерактивным и не заменяет ещё не отправленную интерактивную правку того же сообщения
+    def edit(self, chat_id: int, message_id: int, text: str, background: bool = False, **kwargs):
+        key = (chat_id, message_id)
+        pending = self._pending.get(key)
+        queued_at = time.monotonic()
+        if pending is not None:
+            self.coalesced += 1
+            if background and not pending[1]:
+                return
+        if pending is None or (pending[1] and not background):
+            lanes = self._background if background else self._queues
+            lanes.setdefault(chat_id, deque()).append(key)
+        else:
+            queued_at = pending[2]  # ожидание считаем от первой правки, которую заменяет эта
+        self._pending[key] = (dict(text=text, **kwargs), background, queued_at)
+        wakeup = self._wakeups.get(chat_id)
+        if wakeup is not None:
+            wakeup.set()
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _edit_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._edit_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._edit_buckets[chat_id] = TokenBucket(self.edit_rate, self.edit_burst)
+        return bucket
+
+    def _delay(self, chat_id: int, background: bool) -> float:
+        if background:
+            return max(self._bucket(chat_id).wait_time(self.chat_reserve),
+                       self._global_bucket.wait_time(self.global_reserve))
+        return self._edit_bucket(chat_id).wait_time() if self.edit_rate else 0.0
+
+    def _take(self, chat_id: int, background: bool):
+        if background:
+            self._bucket(chat_id).take()
+            self._global_bucket.take()
+            return
+        if self.edit_rate:
+            self._edit_bucket(chat_id).take()
+        self._bucket(chat_id).take_now()
+        self._global_bucket.take_now()
+
+    # Следующая правка чата, когда на неё есть жетон: (key, (kwargs, фоновая, поставлена)) или None — очереди пусты
+    async def _next(self, chat_id: int):
+        while True:
+            interactive = self._queues.get(chat_id)
+            background = self._background.get(chat_id)
+            if interactive:
+                lane, is_background = interactive, False
+            elif background:
+                lane, is_background = background, True
+            else:
+                return None
+            key = lane[0]
+            pending = self._pending.get(key)
+            if pending is None or pending[1] != is_background:
+                lane.popleft()  # правка уже отправлена или переехала в другую полосу
+                continue
+            delay = self._delay(chat_id, is_background)
+            if not delay:
+                lane.popleft()
+                del self._pending[key]
+                self._take(chat_id, is_background)
+                return key, pending
+            # Ждём жетон; новая правка будит раньше — интерактивная обгонит фоновую
+            wakeup = self._wakeups[chat_id] = asyncio.Event()
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._wakeups.pop(chat_id, None)
+
+    async def _drain(self, chat_id: int):
+        try:
+            while True:
+                item = await self._next(chat_id)
+                if item is None:
+                    break
+                key, (kwargs, background, queued_at) = item
+                waited = time.monotonic() - queued_at
+                try:
+                    await self.bot.edit_message_text(chat_id=key[0], message_id=key[1], **kwargs)
+                    self.sent += 1
+                    if background:
+                        self.sent_background += 1
+                    self._observe_wait(waited, background)
+                except RetryAfter as e:
+                    self.retries += 1
+                    # Возвращаем правку в начало её полосы, если за это время не пришла более новая
+                    if key not in self._pending:
+                        self._pending[key] = (kwargs, background, queued_at)
+                        lanes = self._background if background else self._queues
+                        lanes.setdefault(chat_id, deque()).appendleft(key)
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    await asyncio.sleep(delay)
+                except BadRequest as e:
+                    self._observe_wait(waited, background)
+                    if "not modified" not in str(e).lower():
+                        self._fail(key, e)
+                except TelegramError as e:
+                    self._observe_wait(waited, background)
+                    self._fail(key, e)
+        finally:
+            del self._workers[chat_id]
+            for lanes in (self._queues, self._background):
+                if not lanes.get(chat_id):
+                    lanes.pop(chat_id, None)
+
+    @staticmethod
+    def _observe_wait(seconds: float, background: bool):
+        metrics.observe("bot_outbox_wait_seconds", seconds, lane="background" if background else "interactive")
+
+    def _fail(self, key, error: Exception):
+        self.failed += 1
+        logger.warning("edit %s failed: %s", key, error)
+        if self.on_error is not None:
+            self.on_error(key[0], key[1], error)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "background": self.sent_background,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "failed": self.failed,
+            "pending": len(self._pending),
+        }
+
+    # Дожидается отправки накопленных правок (вызывается до остановки бота)
+    async def stop(self, timeout: float = STOP_TIMEOUT):
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,115 @@
+# recorder.py
+# Запись входящих апдейтов в JSONL для последующего воспроизведения (replay.py).
+# Включается переменной RECORD_UPDATES=путь; запись дописывается в конец файла.
+#
+# Данные обезличиваются при записи: id пользователей (и личных чатов) заменяются
+# псевдонимами HMAC(RECORD_SALT, id), username — "user<псевдоним>", имена удаляются,
+# упоминания @username в тексте заменяются теми же псевдонимами. Так же заменяются
+# id в данных кнопок close_<id> и числовые аргументы /sponsor и /unsponsor,
+# чтобы при воспроизведении они совпадали с псевдонимами. Одинаковая соль
+# даёт одинаковые псевдонимы между перезапусками; без RECORD_SALT соль случайная.
+#
+# Формат: строка {"meta": {...}} в начале каждой сессии записи, затем
+# по строке {"ts": unix-время, "update": Update.to_dict()} на апдейт.
+import os
+import re
+import hmac
+import json
+import time
+import hashlib
+import logging
+
+FLUSH_INTERVAL = 1.0  # секунды: как часто сбрасывать буфер файла на диск
+
+# Поля пользователя, которые сохраняются как есть (остальные персональные — удаляются)
+USER_KEEP_FIELDS = ("is_bot",)
+MENTION_RE = re.compile(r"(?<!\w)@(\w{3,32})")
+# id пользователя в данных кнопки «Закрыть» (main.build_calendar_markup)
+CALLBACK_USER_RE = re.compile(r"^(close_)(\d+)$")
+SPONSOR_ID_RE = re.compile(r"^(/(?:un)?sponsor(?:@\w+)?\s+)(\d+)\b", re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRecorder:
+    def __init__(self, path: str, salt: str = None):
+        self.path = path
+        self.recorded = 0
+        self._salt = (salt or os.urandom(16).hex()).encode()
+        self._file = None
+        self._flushed_at = 0.0
+
+    def pseudonym(self, value) -> int:
+        digest = hmac.new(self._salt, str(value).lower().encode(), hashlib.sha256).digest()
+        # 48 бит: помещается в id Telegram и в точное целое JSON
+        return int.from_bytes(digest[:6], "big") or 1
+
+    def _username(self, username: str) -> str:
+        return f"user{self.pseudonym('@' + username)}"
+
+    def _user(self, user: dict) -> dict:
+        anonymized = {key: user[key] for key in USER_KEEP_FIELDS if key in user}
+        anonymized["id"] = self.pseudonym(user["id"])
+        anonymized["first_name"] = "User"
+        if user.get("username"):
+            anonymized["username"] = self._username(user["username"])
+        return anonymized
+
+    def _user_id(self, match) -> str:
+        return f"{match.group(1)}{self.pseudonym(int(match.group(2)))}"
+
+    def _text(self, text: str) -> str:
+        text = SPONSOR_ID_RE.sub(self._user_id, text)
+        return MENTION_RE.sub(lambda m: "@" + self._username(m.group(1)), text)
+
+    def anonymize(self, data):
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        if "is_bot" in data:
+            return self._user(data)
+        if data.get("type") == "private" and "id" in data:
+            return {"id": self.pseudonym(data["id"]), "type": "private"}
+        result = {}
+        for key, value in data.items():
+            if key in ("text", "caption") and isinstance(value, str):
+                result[key] = self._text(value)
+            elif key in ("data", "callback_data") and isinstance(value, str):
+                result[key] = CALLBACK_USER_RE.sub(self._user_id, value)
+            elif key in ("entities", "caption_entities"):
+                # Смещения упоминаний меняются вместе с текстом — оставляем только команды,
+                # они стоят в начале сообщения
+                result[key] = [e for e in value if e.get("type") == "bot_command"]
+            else:
+                result[key] = self.anonymize(value)
+        return result
+
+    def open(self, meta: dict):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._write({"meta": {"started": time.time(), **meta}})
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        now = time.monotonic()
+        if now - self._flushed_at >= FLUSH_INTERVAL:
+            self._file.flush()
+            self._flushed_at = now
+
+    # Обработчик TypeHandler(Update): только записывает, обработку не останавливает
+    async def record(self, update, context):
+        if self._file is None:
+            return
+        try:
+            self._write({"ts": time.time(), "update": self.anonymize(update.to_dict())})
+            self.recorded += 1
+        except (OSError, TypeError, ValueError):
+            logger.exception("update %s not recorded", update.update_id)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        return {"recorded": self.recorded, "path": self.path}
@@ -0,0 +1,291 @@
+# replay.py
+# Воспроизведение записанных апдейтов (RECORD_UPDATES, см. recorder.py) через
+# настоящий стек бота: Application из main.build_application, фильтры диспетчера
+# и обработчики. Telegram подменён на уровне HTTP-клиента (FakeTelegramRequest),
+# хранилище — временное (SQLite во временном каталоге или память).
+#
+#   python replay.py updates.jsonl                 # в реальном темпе записи
+#   python replay.py updates.jsonl --speed 10      # в 10 раз быстрее
+#   python replay.py updates.jsonl --speed 0       # без пауз, максимально быстро
+#   python replay.py updates.jsonl --speed 0 --concurrency 1 --output replay.json
+#
+# Печатаются пропускная способность, p50/p99 обработки апдейта, число вызовов
+# Telegram API и контрольная сумма итоговых броней каждого календаря. Сумма
+# воспроизводима при --concurrency 1: параллельные гонки за одну дату могут
+# закончиться по-разному. Ограничение частоты нажатий (throttle.py) зависит от
+# реального времени, поэтому по умолчанию отключено (--throttle включает).
+# Лимиты Telegram в очереди правок тоже отключены; с --telegram-limits они
+# настоящие, и печатается ожидание ответов на нажатия в очереди.
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+from telegram.request import BaseRequest
+
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+# Календарь листается на год вперёд: его брони тоже входят в контрольную сумму
+CHECKSUM_DAYS_AHEAD = 400
+REPLAY_BOT = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+
+# --- Запись ---
+def load_recording(path: str):
+    metas, records = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "meta" in record:
+                metas.append(record["meta"])
+            else:
+                records.append(record)
+    return metas, records
+
+# Паузы между апдейтами с учётом скорости; перерывы длиннее max_gap (перезапуски бота) сжимаются
+def schedule(records, speed: float, max_gap: float):
+    offsets = []
+    offset = 0.0
+    previous = None
+    for record in records:
+        if previous is not None and speed:
+            offset += min(max(record["ts"] - previous, 0.0), max_gap) / speed
+        previous = record["ts"]
+        offsets.append(offset)
+    return offsets
+
+def recorded_tenants(metas, records):
+    tenants = []
+    for meta in metas:
+        tenants.extend(tuple(t) for t in meta.get("tenants", []))
+    if not tenants:
+        for record in records:
+            update = record["update"]
+            message = update.get("message") or update.get("callback_query", {}).get("message")
+            if message:
+                tenants.append((message["chat"]["id"], message.get("message_thread_id")))
+    return list(dict.fromkeys(tenants))
+
+def configure_env(metas, records, args):
+    # main.py читает настройки при импорте, поэтому окружение готовится до него.
+    # Пустые значения не перезаписываются из .env (load_dotenv не трогает заданные переменные)
+    tenants = recorded_tenants(metas, records)
+    if not tenants:
+        sys.exit("В записи нет ни одного календаря")
+    admin = next((m["super_admin_id"] for m in metas if "super_admin_id" in m), 0)
+    os.environ["BOT_TOKEN"] = "0:replay"
+    os.environ["SUPER_ADMIN_ID"] = str(admin)
+    os.environ["ALLOWED_CHAT_ID"] = ""
+    os.environ["ALLOWED_THREAD_ID"] = ""
+    os.environ["ALLOWED_TOPICS"] = ",".join(f"{c}:{t}" if t is not None else str(c) for c, t in tenants)
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ["RECORD_UPDATES"] = ""
+    os.environ["METRICS_PORT"] = ""
+
+
+# --- Поддельный Telegram: отвечает на вызовы Bot API без сети ---
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = 10 ** 6
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def _message(self, params: dict, message_id: int = None):
+        if message_id is None:
+            self._message_ids += 1
+            message_id = self._message_ids
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "supergroup"},
+            "from": REPLAY_BOT,
+            "text": params.get("text", ""),
+        }
+        if params.get("message_thread_id") is not None:
+            message["message_thread_id"] = params["message_thread_id"]
+        return message
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = REPLAY_BOT
+        elif api_method == "sendMessage":
+            result = self._message(params)
+        elif api_method == "editMessageText":
+            result = self._message(params, params.get("message_id"))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- Контрольная сумма броней ---
+def checksum_range(records):
+    today = date.today()
+    dates = [today.isoformat(), (today + timedelta(days=CHECKSUM_DAYS_AHEAD)).isoformat()]
+    for record in records:
+        dates.extend(DATE_RE.findall(json.dumps(record["update"])))
+    return min(dates), max(dates)
+
+async def bookings_checksum(storage, tenant, start_str: str, end_str: str):
+    bookings = await storage.get_bookings_between(start_str, end_str, tenant)
+    digest = hashlib.sha256()
+    for date_str in sorted(bookings):
+        booking = bookings[date_str]
+        digest.update(f"{date_str}:{booking['user_id']}:{int(booking['is_sponsor'])}\n".encode())
+    return {"bookings": len(bookings), "sha256": digest.hexdigest()[:16]}
+
+
+# --- Воспроизведение ---
+async def replay(records, args):
+    import db
+    import main
+    from bench import percentile
+    from metrics import metrics
+    from outbox import Outbox
+    from telegram import Update
+    from throttle import CallbackThrottle
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "replay.db")
+        db.TENANT_DB_DIR = os.path.join(tmp, "tenants")
+        if not args.throttle:
+            main.callback_throttle = CallbackThrottle(dedup_window=0, rate=float("inf"), burst=float("inf"))
+        if args.telegram_limits:
+            main.outbox = Outbox(edit_rate=main.OUTBOX_EDIT_RATE, edit_burst=main.OUTBOX_EDIT_BURST,
+                                 on_error=main.on_edit_failed)
+        else:
+            # Без --telegram-limits правки уходят в поддельный API сразу
+            main.outbox = Outbox(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, on_error=main.on_edit_failed)
+
+        request = FakeTelegramRequest(args.api_latency / 1000)
+        app = main.build_application(request=request, updater=False)
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def process(data):
+            nonlocal errors
+            async with semaphore:
+                update = Update.de_json(data, app.bot)
+                started = time.perf_counter()
+                try:
+                    await app.process_update(update)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        await app.initialize()
+        await main.post_init(app)
+        try:
+            offsets = schedule(records, args.speed, args.max_gap)
+            tasks = []
+            started = time.perf_counter()
+            for offset, record in zip(offsets, records):
+                delay = started + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(process(record["update"])))
+                if args.concurrency == 1:
+                    await tasks[-1]
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+            await main.post_stop(app)
+
+            start_str, end_str = checksum_range(records)
+            checksums = {
+                f"{chat}:{thread}": await bookings_checksum(main.storage, (chat, thread), start_str, end_str)
+                for chat, thread in main.ALLOWED_TOPICS
+            }
+        finally:
+            await app.shutdown()
+            await main.post_shutdown(app)
+
+    return {
+        "updates": len(records),
+        "speed": args.speed,
+        "backend": args.backend,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(records) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+        # Исключения обработчиков перехватывает Application — считаем их по метрикам timed_handler
+        "errors": errors + sum(metrics.counters("bot_handler_errors_total").values()),
+        "telegram_calls": request.calls,
+        "throttled": main.callback_throttle.stats() if args.throttle else None,
+        "edit_wait_ms": {
+            dict(lane)["lane"]: {"p50": h.percentile(50) * 1000, "p99": h.percentile(99) * 1000, "max": h.max * 1000}
+            for lane, h in metrics.histograms("bot_outbox_wait_seconds").items()
+        },
+        "checksums": checksums,
+    }
+
+
+def print_result(result):
+    print(
+        f"{result['updates']} апдейтов за {result['elapsed_s']:.2f} с ({result['throughput_per_s']:.0f}/с), "
+        f"p50 {result['p50_ms']:.2f} мс, p99 {result['p99_ms']:.2f} мс, max {result['max_ms']:.2f} мс, "
+        f"ошибок {result['errors']}"
+    )
+    print("Telegram API: " + ", ".join(f"{k}={v}" for k, v in sorted(result["telegram_calls"].items())))
+    for lane, wait in sorted(result["edit_wait_ms"].items()):
+        print(f"Очередь правок ({lane}): p50 {wait['p50']:.2f} мс, p99 {wait['p99']:.2f} мс, max {wait['max']:.2f} мс")
+    if result["throttled"]:
+        print("Нажатия: " + ", ".join(f"{k}={v}" for k, v in result["throttled"].items()))
+    for tenant, checksum in result["checksums"].items():
+        print(f"Календарь {tenant}: броней {checksum['bookings']}, sha256 {checksum['sha256']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов через обработчики бота")
+    parser.add_argument("recording", help="JSONL-файл, записанный с RECORD_UPDATES")
+    parser.add_argument("--speed", type=float, default=1.0, help="множитель темпа; 0 — без пауз")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="максимальная пауза между апдейтами в записи, с")
+    parser.add_argument("--concurrency", type=int, default=32, help="апдейтов в обработке одновременно")
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка поддельного Telegram API, мс")
+    parser.add_argument("--throttle", action="store_true", help="не отключать ограничение частоты нажатий")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="очередь правок с настоящими лимитами Telegram (OUTBOX_EDIT_RATE из окружения)")
+    parser.add_argument("--output", help="куда сохранить результат в JSON")
+    return parser.parse_args(argv)
+
+
+def replay_main(argv=None):
+    args = parse_args(argv)
+    metas, records = load_recording(args.recording)
+    if not records:
+        sys.exit("Запись пуста")
+    configure_env(metas, records, args)
+    result = asyncio.run(replay(records, args))
+    print_result(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.time(), "args": vars(args), "result": result}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    replay_main()
@@ -0,0 +1,306 @@
+# storage.py
+# Хранилище пользователей и броней за общим интерфейсом Storage. Обработчики бота
+# работают только с ним, реализация выбирается при запуске (STORAGE_BACKEND):
+#   sqlite — файлы SQLite через db.py (по умолчанию);
+#   memory — словари в памяти процесса, без потоков и диска (бенчмарки и проверки).
+# Правила приоритета броней и коды результатов общие — из db.py (обработчики
+# импортируют коды оттуда же).
+import time
+import heapq
+from datetime import date, timedelta
+from typing import Protocol
+
+import db
+from db import (
+    booking_decision, SUPER_ADMIN_ID,
+    BOOKING_BOOKED, BOOKING_REPLACED,
+    CANCEL_CANCELLED, CANCEL_NOT_YOURS, CANCEL_FREE,
+    AUDIT_BOOK, AUDIT_REPLACE, AUDIT_CANCEL,
+)
+
+
+# tenant=None везде означает календарь по умолчанию (переданный в init)
+class Storage(Protocol):
+    name: str
+
+    async def init(self, default_tenant=None): ...
+    async def close(self): ...
+    # {заголовок: {счётчик: значение}} для /stats
+    def stats(self) -> dict: ...
+
+    # Пользователи: профиль {"user_id", "username", "is_sponsor", "is_super_admin"}
+    async def get_user(self, user_id: int): ...
+    async def ensure_user(self, user_id: int, username: str = None): ...
+    async def set_sponsor_status(self, target_user_id: int, is_sponsor: bool): ...
+    async def get_user_id_by_username(self, username: str): ...
+
+    # Брони: {"user_id", "username", "is_sponsor"} или None
+    def bookings_version(self, tenant=None) -> int: ...
+    async def get_booking(self, date_str: str, tenant=None): ...
+    async def get_bookings_between(self, start_str: str, end_str: str, tenant=None): ...
+    async def set_booking(self, date_str: str, user_id: int, username: str, is_sponsor: bool, tenant=None): ...
+    async def set_bookings(self, dates, user_id: int, username: str, is_sponsor: bool, tenant=None): ...
+    async def cancel_booking(self, date_str: str, tenant=None): ...
+    async def cancel_bookings(self, dates, user_id: int, tenant=None): ...
+
+    # Отчёты, журнал и обслуживание
+    async def get_user_bookings(self, user_id: int, from_str: str, tenant=None): ...
+    async def get_occupancy(self, months, top_users: int = 10, tenant=None): ...
+    async def get_audit_log(self, tenant=None, before_id: int = None, limit: int = 10): ...
+    async def archive_bookings(self, before_str: str, batch_size: int = db.ARCHIVE_BATCH_SIZE, tenant=None): ...
+
+
+# --- SQLite: функции db.py ---
+class SqliteStorage:
+    name = "sqlite"
+
+    init = staticmethod(db.init_db)
+    close = staticmethod(db.close_db)
+    get_user = staticmethod(db.get_user)
+    ensure_user = staticmethod(db.ensure_user)
+    set_sponsor_status = staticmethod(db.set_sponsor_status)
+    get_user_id_by_username = staticmethod(db.get_user_id_by_username)
+    bookings_version = staticmethod(db.bookings_version)
+    get_booking = staticmethod(db.get_booking)
+    get_bookings_between = staticmethod(db.get_bookings_between)
+    set_booking = staticmethod(db.set_booking)
+    set_bookings = staticmethod(db.set_bookings)
+    cancel_booking = staticmethod(db.cancel_booking)
+    cancel_bookings = staticmethod(db.cancel_bookings)
+    get_user_bookings = staticmethod(db.get_user_bookings)
+    get_occupancy = staticmethod(db.get_occupancy)
+    get_audit_log = staticmethod(db.get_audit_log)
+    archive_bookings = staticmethod(db.archive_bookings)
+
+    def stats(self) -> dict:
+        return {
+            "Кэш броней": db.booking_cache_stats(),
+            "Кэш пользователей": db.user_cache_stats(),
+            "Журнал аудита": db.audit_stats(),
+        }
+
+
+# --- В памяти процесса ---
+# Все методы выполняются в цикле событий без await внутри, поэтому каждая
+# операция атомарна так же, как транзакция в SQLite. Данные живут до close().
+class _MemoryCalendar:
+    def __init__(self):
+        self.bookings = {}       # date -> бронь
+        self.archive = {}        # date -> бронь
+        self.user_stats = {}     # user_id -> {"username", "days", "sponsor_days"}
+        self.month_stats = {}    # "YYYY-MM" -> {"days", "sponsor_days"}
+        self.totals = {"days": 0, "sponsor_days": 0}
+        self.version = db.next_bookings_version()  # общий счётчик с SQLite, см. db.py
+
+    def count(self, date_str: str, booking, delta: int):
+        sponsor_delta = delta if booking["is_sponsor"] else 0
+        user = self.user_stats.setdefault(
+            booking["user_id"], {"username": booking["username"], "days": 0, "sponsor_days": 0}
+        )
+        if delta > 0:
+            user["username"] = booking["username"]
+        user["days"] += delta
+        user["sponsor_days"] += sponsor_delta
+        month = self.month_stats.setdefault(date_str[:7], {"days": 0, "sponsor_days": 0})
+        month["days"] += delta
+        month["sponsor_days"] += sponsor_delta
+        self.totals["days"] += delta
+        self.totals["sponsor_days"] += sponsor_delta
+
+
+class MemoryStorage:
+    name = "memory"
+
+    def __init__(self):
+        self._users = {}
+        self._calendars = {}
+        self._audit = []
+        self._default_tenant = None
+
+    async def init(self, default_tenant=None):
+        self._default_tenant = default_tenant
+        self._users.setdefault(SUPER_ADMIN_ID, {
+            "user_id": SUPER_ADMIN_ID, "username": None, "is_sponsor": False, "is_super_admin": True,
+        })
+
+    async def close(self):
+        self._users.clear()
+        self._calendars.clear()
+        self._audit.clear()
+        self._default_tenant = None
+
+    def stats(self) -> dict:
+        return {
+            "Хранилище в памяти": {
+                "users": len(self._users),
+                "calendars": len(self._calendars),
+                "bookings": sum(len(c.bookings) for c in self._calendars.values()),
+                "audit": len(self._audit),
+            },
+        }
+
+    def _tenant(self, tenant):
+        return tenant if tenant is not None else self._default_tenant
+
+    def _calendar(self, tenant) -> _MemoryCalendar:
+        tenant = self._tenant(tenant)
+        cal = self._calendars.get(tenant)
+        if cal is None:
+            cal = self._calendars[tenant] = _MemoryCalendar()
+        return cal
+
+    # --- Пользователи ---
+    async def get_user(self, user_id: int):
+        profile = self._users.get(user_id)
+        return dict(profile) if profile else None
+
+    async def ensure_user(self, user_id: int, username: str = None):
+        profile = self._users.get(user_id)
+        if profile is None:
+            profile = self._users[user_id] = {
+                "user_id": user_id, "username": username or "unknown", "is_sponsor": False, "is_super_admin": False,
+            }
+        elif username:
+            profile["username"] = username
+        return dict(profile)
+
+    async def set_sponsor_status(self, target_user_id: int, is_sponsor: bool):
+        profile = self._users.get(target_user_id)
+        if profile is not None:
+            profile["is_sponsor"] = bool(is_sponsor)
+
+    async def get_user_id_by_username(self, username: str):
+        wanted = username.lower()
+        for profile in self._users.values():
+            if profile["username"] and profile["username"].lower() == wanted:
+                return profile["user_id"]
+        return None
+
+    # --- Брони ---
+    def bookings_version(self, tenant=None) -> int:
+        return self._calendar(tenant).version
+
+    async def get_booking(self, date_str: str, tenant=None):
+        booking = self._calendar(tenant).bookings.get(date_str)
+        return dict(booking) if booking else None
+
+    async def get_bookings_between(self, start_str: str, end_str: str, tenant=None):
+        bookings = self._calendar(tenant).bookings
+        result = {}
+        d, end = date.fromisoformat(start_str), date.fromisoformat(end_str)
+        while d <= end:
+            booking = bookings.get(d.isoformat())
+            if booking:
+                result[d.isoformat()] = dict(booking)
+            d += timedelta(days=1)
+        return result
+
+    def _record(self, tenant, action: str, date_str: str, user_id: int, username: str, previous=None):
+        chat_id, thread_id = self._tenant(tenant) or (None, None)
+        self._audit.append({
+            "id": len(self._audit) + 1,
+            "ts": time.time(),
+            "chat_id": chat_id,
+            "thread_id": thread_id,
+            "action": action,
+            "date": date_str,
+            "user_id": user_id,
+            "username": username,
+            "previous_user_id": previous["user_id"] if previous else None,
+            "previous_username": previous["username"] if previous else None,
+        })
+
+    def _book(self, tenant, date_str: str, user_id: int, username: str, is_sponsor: bool):
+        cal = self._calendar(tenant)
+        current = cal.bookings.get(date_str)
+        status = booking_decision(current, user_id, is_sponsor)
+        if status in (BOOKING_BOOKED, BOOKING_REPLACED):
+            booking = {"user_id": user_id, "username": username, "is_sponsor": bool(is_sponsor)}
+            if current:
+                cal.count(date_str, current, -1)
+            cal.count(date_str, booking, 1)
+            cal.bookings[date_str] = booking
+            cal.version = db.next_bookings_version()
+            self._record(tenant, AUDIT_REPLACE if status == BOOKING_REPLACED else AUDIT_BOOK,
+                         date_str, user_id, username, current)
+        return {"status": status, "previous": dict(current) if current else None}
+
+    async def set_booking(self, date_str: str, user_id: int, username: str, is_sponsor: bool, tenant=None):
+        return self._book(tenant, date_str, user_id, username, is_sponsor)
+
+    async def set_bookings(self, dates, user_id: int, username: str, is_sponsor: bool, tenant=None):
+        return {d: self._book(tenant, d, user_id, username, is_sponsor) for d in dates}
+
+    def _cancel(self, tenant, date_str: str):
+        cal = self._calendar(tenant)
+        booking = cal.bookings.pop(date_str, None)
+        if booking:
+            cal.version = db.next_bookings_version()
+            cal.count(date_str, booking, -1)
+            self._record(tenant, AUDIT_CANCEL, date_str, booking["user_id"], booking["username"])
+
+    async def cancel_booking(self, date_str: str, tenant=None):
+        self._cancel(tenant, date_str)
+
+    async def cancel_bookings(self, dates, user_id: int, tenant=None):
+        bookings = self._calendar(tenant).bookings
+        results = {}
+        for date_str in dates:
+            booking = bookings.get(date_str)
+            if booking is None:
+                results[date_str] = CANCEL_FREE
+            elif booking["user_id"] != user_id:
+                results[date_str] = CANCEL_NOT_YOURS
+            else:
+                results[date_str] = CANCEL_CANCELLED
+                self._cancel(tenant, date_str)
+        return results
+
+    # --- Отчёты, журнал и обслуживание ---
+    async def get_user_bookings(self, user_id: int, from_str: str, tenant=None):
+        bookings = self._calendar(tenant).bookings
+        return [
+            {"date": d, "is_sponsor": b["is_sponsor"]}
+            for d, b in sorted(bookings.items()) if d >= from_str and b["user_id"] == user_id
+        ]
+
+    async def get_occupancy(self, months, top_users: int = 10, tenant=None):
+        cal = self._calendar(tenant)
+        ranked = heapq.nlargest(top_users, cal.user_stats.items(), key=lambda item: item[1]["days"])
+        return {
+            "users": [
+                {"user_id": user_id, **stats} for user_id, stats in ranked[:top_users] if stats["days"] > 0
+            ],
+            "days": cal.totals["days"],
+            "sponsor_days": cal.totals["sponsor_days"],
+            "months": {m: dict(cal.month_stats.get(m, {"days": 0, "sponsor_days": 0})) for m in months},
+        }
+
+    async def get_audit_log(self, tenant=None, before_id: int = None, limit: int = 10):
+        chat_id, thread_id = self._tenant(tenant) or (None, None)
+        events = []
+        for event in reversed(self._audit[:before_id - 1] if before_id is not None else self._audit):
+            if event["chat_id"] == chat_id and event["thread_id"] == thread_id:
+                events.append({k: v for k, v in event.items() if k not in ("chat_id", "thread_id")})
+                if len(events) == limit:
+                    break
+        return events
+
+    async def archive_bookings(self, before_str: str, batch_size: int = db.ARCHIVE_BATCH_SIZE, tenant=None):
+        cal = self._calendar(tenant)
+        past = [d for d in cal.bookings if d < before_str]
+        for date_str in past:
+            cal.archive[date_str] = cal.bookings.pop(date_str)
+        return {"archived": len(past), "pages_freed": 0, "bookings": len(cal.bookings)}
+
+
+BACKENDS = {
+    SqliteStorage.name: SqliteStorage,
+    MemoryStorage.name: MemoryStorage,
+}
+
+def create_storage(name: str) -> Storage:
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={name!r}, доступны: {', '.join(BACKENDS)}")
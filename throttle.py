@@ -0,0 +1,70 @@
+# throttle.py
+# Защита от «залипших» кнопок: одинаковые нажатия одного пользователя на одном
+# сообщении в коротком окне считаются повтором, а частота нажатий каждого
+# пользователя ограничена ведром жетонов. Решение принимается в памяти, до
+# обращений к БД и Telegram (см. throttle_callbacks в main.py).
+import time
+from collections import OrderedDict
+
+from outbox import TokenBucket
+
+DEDUP_WINDOW = 0.7   # секунды: повтор того же callback_data на том же сообщении
+USER_RATE = 4        # нажатий в секунду в среднем
+USER_BURST = 8       # подряд без ожидания
+IDLE_TIMEOUT = 60    # ведро без нажатий дольше этого забывается
+
+# Результаты CallbackThrottle.check
+PASS = None
+DUPLICATE = "duplicate"
+RATE_LIMITED = "rate_limited"
+
+
+class CallbackThrottle:
+    def __init__(self, dedup_window: float = DEDUP_WINDOW, rate: float = USER_RATE, burst: float = USER_BURST):
+        self.dedup_window = dedup_window
+        self.rate = rate
+        self.burst = burst
+        self.passed = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+        self._recent = OrderedDict()   # (user_id, chat_id, message_id, data) -> время нажатия
+        self._buckets = OrderedDict()  # user_id -> TokenBucket, от давно нажимавших к недавним
+
+    def _expire(self, now: float):
+        while self._recent:
+            key, seen = next(iter(self._recent.items()))
+            if now - seen < self.dedup_window:
+                break
+            del self._recent[key]
+        while self._buckets:
+            user_id, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < IDLE_TIMEOUT:
+                break
+            del self._buckets[user_id]
+
+    def check(self, user_id: int, chat_id: int, message_id: int, data: str):
+        now = time.monotonic()
+        self._expire(now)
+
+        key = (user_id, chat_id, message_id, data)
+        if key in self._recent:
+            self.duplicates += 1
+            return DUPLICATE
+
+        bucket = self._buckets.pop(user_id, None) or TokenBucket(self.rate, self.burst)
+        self._buckets[user_id] = bucket
+        if bucket.wait_time():
+            self.rate_limited += 1
+            return RATE_LIMITED
+        bucket.take()
+        self._recent[key] = now
+        self.passed += 1
+        return PASS
+
+    def stats(self):
+        return {
+            "passed": self.passed,
+            "duplicates": self.duplicates,
+            "rate_limited": self.rate_limited,
+            "users": len(self._buckets),
+        }
@@ -0,0 +1,102 @@
+# webhook.py
+# Режим вебхука: локальный HTTP-сервер принимает POST с апдейтами от Telegram,
+# проверяет секретный токен и кладёт апдейты в очередь Application.
+#
+# Локальная проверка без Telegram (WEBHOOK_URL не задан — вебхук не регистрируется):
+#   curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json http://127.0.0.1:8443/telegram
+#
+# Без секрета эндпоинт не работает: если WEBHOOK_SECRET не задан, но задан WEBHOOK_URL,
+# секрет генерируется при запуске и передаётся в setWebhook; иначе запуск прерывается.
+import hmac
+import json
+import secrets
+import signal
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import Application
+
+from httpd import HttpServer, Response
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+DRAIN_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def create_webhook_server(application: Application, host: str, port: int, path: str, secret_token: str) -> HttpServer:
+    if not secret_token:
+        raise ValueError("webhook secret token is required")
+
+    async def handle(request):
+        if request.path != path:
+            return Response(404)
+        if request.method != "POST":
+            return Response(405)
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return Response(403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return Response(400)
+        if not isinstance(data, dict):
+            return Response(400)
+        try:
+            update = Update.de_json(data, application.bot)
+        except (TypeError, KeyError, ValueError):
+            return Response(400)
+        await application.update_queue.put(update)
+        return Response(200)
+
+    return HttpServer(handle, host, port)
+
+
+async def serve_webhook(application: Application, host: str, port: int, path: str,
+                        secret_token: str = None, webhook_url: str = None):
+    if not secret_token:
+        if not webhook_url:
+            raise SystemExit("BOT_MODE=webhook: задайте WEBHOOK_SECRET (или WEBHOOK_URL для случайного секрета)")
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан — используется случайный секрет этого запуска")
+
+    # Повторяет жизненный цикл run_polling: post_init/post_stop/post_shutdown вызываются так же
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = create_webhook_server(application, host, port, path, secret_token)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+            )
+        await application.start()
+        await server.start()
+        logger.info("webhook listening on %s:%s%s", host, server.port, path)
+
+        await stop.wait()
+
+        # Сначала перестаём принимать запросы и дожидаемся начатых,
+        # затем Application дообрабатывает очередь апдейтов
+        await server.stop(DRAIN_TIMEOUT)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await server.stop(DRAIN_TIMEOUT)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, host: str, port: int, path: str,
+                secret_token: str = None, webhook_url: str = None):
+    asyncio.run(serve_webhook(application, host, port, path, secret_token, webhook_url))